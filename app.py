@@ -1,18 +1,33 @@
 import eventlet
 eventlet.monkey_patch()
+from eventlet.green import subprocess
 
 import os
 import io
+import re
+import json
 import base64
-import tempfile
-import subprocess
+import hashlib
+import uuid
+import wave
+import queue
+import shutil
+import threading
+import socket
 import logging
 import sys
-from flask import Flask, render_template, jsonify
+import av
+import greenlet
+import numpy as np
+from flask import Flask, render_template, jsonify, request
 from flask_socketio import SocketIO, emit
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
 from pathlib import Path
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from urllib.parse import urlparse
 import time
 
 # Configure logging to stdout
@@ -25,6 +40,10 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Upstream I/O relies on green sockets; fail loudly if patching was bypassed
+if not all(eventlet.patcher.is_monkey_patched(module) for module in ('socket', 'select', 'thread', 'time')):
+    logger.warning("eventlet monkey patching is incomplete; upstream calls may block the hub")
+
 # Load environment variables
 load_dotenv()
 logger.info("Environment variables loaded")
@@ -33,7 +52,10 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = 'shifokor-secret-key-2024'
 logger.info("Flask app created")
 
-socketio = SocketIO(app, cors_allowed_origins="*", max_http_buffer_size=10e6, async_mode="eventlet")
+# A message queue lets any worker emit to clients connected to another worker
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE") or os.getenv("SESSION_REDIS_URL") or None
+socketio = SocketIO(app, cors_allowed_origins="*", max_http_buffer_size=10e6, async_mode="eventlet",
+                    message_queue=SOCKETIO_MESSAGE_QUEUE)
 logger.info("SocketIO initialized with CORS enabled")
 
 AISHA_API_KEY = os.getenv("AISHA_API_KEY")
@@ -54,8 +76,564 @@ STT_URL = "https://back.aisha.group/api/v1/stt/post/"
 TTS_URL = "https://back.aisha.group/api/v1/tts/post/"
 GROQ_URL = "https://api.groq.com/openai/v1/chat/completions"
 
-# System prompt for Sofia
-SYSTEM_PROMPT = """# Customer Service & Support Agent Prompt
+# Upstream connection pools and per-endpoint timeouts (seconds)
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "10"))
+STT_TIMEOUT = float(os.getenv("STT_TIMEOUT", "12"))  # slightly higher for Render network
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "20"))
+TTS_TIMEOUT = float(os.getenv("TTS_TIMEOUT", "8"))
+TTS_GREETING_TIMEOUT = float(os.getenv("TTS_GREETING_TIMEOUT", "10"))
+TTS_MAX_ATTEMPTS = int(os.getenv("TTS_MAX_ATTEMPTS", "3"))
+
+# Per-upstream circuit breaker (failure rate over a sliding window, half-open probes)
+CIRCUIT_WINDOW = float(os.getenv("CIRCUIT_WINDOW", "30"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "10"))
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "15"))
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", "1"))
+
+# Per-upstream adaptive (AIMD) concurrency limit
+CONCURRENCY_LIMIT_INITIAL = int(os.getenv("CONCURRENCY_LIMIT_INITIAL", "20"))
+CONCURRENCY_LIMIT_MIN = int(os.getenv("CONCURRENCY_LIMIT_MIN", "2"))
+CONCURRENCY_LIMIT_MAX = int(os.getenv("CONCURRENCY_LIMIT_MAX", "200"))
+AIMD_BACKOFF = float(os.getenv("AIMD_BACKOFF", "0.7"))
+
+# Hedged upstream calls: a backup attempt fires once the first is slower than
+# the recent HEDGE_PERCENTILE latency, for at most HEDGE_MAX_RATIO of calls
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "true").lower() != "false"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "1.5"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.2"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))
+
+# TTS voice settings (also part of the TTS cache key)
+TTS_LANGUAGE = "uz"
+TTS_MODEL = "gulnoza"
+TTS_SPEED = "1.6"  # Faster speech
+TTS_MOOD = "happy"
+
+# Synthesized audio cache: in-memory LRU tier plus optional on-disk tier
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "")
+
+# Startup warm-up (DNS, pooled connections, static phrases) gating /health
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() != "false"
+WARMUP_CONNECT_TIMEOUT = float(os.getenv("WARMUP_CONNECT_TIMEOUT", "5"))
+
+# Fixed phrases spoken without the LLM
+GREETING_TEXT = "Assalomu alaykum! Men Sofia. Qanday yordam bera olaman?"
+SILENCE_NUDGE_TEXT = "Men sizni eshita olmayapman. Iltimos, balandroq gapiring yoki qaytadan ayting."
+
+# FAQ turns answered without the LLM: (intent, regex over normalized text, answer).
+# The answer is followed by FAQ_FOLLOW_UP_TEXT, or by the pending question of a booking
+FAQ_ROUTER_ENABLED = os.getenv("FAQ_ROUTER_ENABLED", "true").lower() != "false"
+FAQ_MAX_WORDS = int(os.getenv("FAQ_MAX_WORDS", "10"))
+FAQ_INTENTS = [
+    ('location',
+     r"\b(manzil\w*|qayer(da|ga)\w*|joylash\w*|lokatsiya\w*|adres\w*|qanday bor\w*)",
+     "Biz Toshkent shahrida, Olmazar tumanida, Talabalar ko'chasida, oltmish beshinchi binodamiz."),
+    ('price',
+     r"\b(narx\w*|necha pul|qancha (pul|turadi|to'la\w*)|to'lov\w*|puli\w*)",
+     "Har bir konsultatsiya ikki yuz ming so'm turadi."),
+    ('duration',
+     r"\b(davomiyli\w*|necha (daqiqa|minut)|qancha (vaqt|davom\w*)|necha soat)",
+     "Har bir konsultatsiya o'ttiz daqiqa davom etadi."),
+]
+FAQ_FOLLOW_UP_TEXT = "Yana savollaringiz bormi?"
+
+
+# Booking state machine: templated questions, read-backs and confirmations
+BOOKING_FLOW_ENABLED = os.getenv("BOOKING_FLOW_ENABLED", "true").lower() != "false"
+# Turns of history the LLM sees while a booking is in progress
+BOOKING_CONTEXT_TURNS = int(os.getenv("BOOKING_CONTEXT_TURNS", "4"))
+BOOKING_QUESTIONS = {
+    'specialty': "Qaysi shifokor yoki mutaxassis qabuliga yozilmoqchisiz?",
+    'time': "Qaysi kun va soat sizga qulay?",
+    'name': "Ism va familiyangizni ayting, iltimos.",
+    'phone': "Telefon raqamingizni ayting, iltimos.",
+    'address': "Manzilingizni ayting, iltimos.",
+}
+BOOKING_SLOT_DESCRIPTIONS = {
+    'specialty': "the doctor or specialty",
+    'time': "the preferred date and time",
+    'name': "the caller's full name (or a yes/no on the name read back)",
+    'phone': "the caller's phone number (or a yes/no on the number read back)",
+    'address': "the caller's address (or a yes/no on the address read back)",
+    'confirm': "a yes/no confirmation of the booking summary",
+    'amend': "which detail to change: doctor, time, name, phone or address",
+}
+BOOKING_CHECK_TEXT = "To'g'rimi?"
+BOOKING_REPEAT_TEXT = "Kechirasiz, qaytadan ayting."
+BOOKING_SUMMARY_TEXT = "Sizni {specialty} qabuliga, {time} yozaman."
+BOOKING_FEE_TEXT = "Konsultatsiya o'ttiz daqiqa davom etadi, narxi ikki yuz ming so'm."
+BOOKING_CONFIRM_TEXT = "Tasdiqlaysizmi?"
+BOOKING_DONE_TEXT = "Rahmat! Qabulingiz tasdiqlandi, tez orada tasdiqlash xabarini olasiz. Yana savollaringiz bormi?"
+BOOKING_AMEND_TEXT = "Qaysi ma'lumotni o'zgartiramiz: shifokor, vaqt, ism, telefon yoki manzil?"
+BOOKING_CANCELLED_TEXT = "Yaxshi, yozilish bekor qilindi. Yana savollaringiz bormi?"
+
+STATIC_PHRASES = ([GREETING_TEXT, SILENCE_NUDGE_TEXT, FAQ_FOLLOW_UP_TEXT] + [answer for _, _, answer in FAQ_INTENTS]
+                  + list(BOOKING_QUESTIONS.values())
+                  + [BOOKING_CHECK_TEXT, BOOKING_REPEAT_TEXT, BOOKING_FEE_TEXT, BOOKING_CONFIRM_TEXT,
+                     BOOKING_DONE_TEXT, BOOKING_AMEND_TEXT, BOOKING_CANCELLED_TEXT])
+
+# Conversation context: recent turns within a token budget plus a rolling summary
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1200"))
+KEEP_RECENT_MESSAGES = int(os.getenv("KEEP_RECENT_MESSAGES", "8"))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "llama-3.1-8b-instant")
+# Tiered model routing: tiered (fast model for short turns, large for booking
+# details and long turns), large or fast to pin one model
+LLM_ROUTING = os.getenv("LLM_ROUTING", "tiered").lower()
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL", "llama-3.1-8b-instant")
+LLM_LARGE_MODEL = os.getenv("LLM_LARGE_MODEL", "llama-3.3-70b-versatile")
+LLM_ESCALATE_WORDS = int(os.getenv("LLM_ESCALATE_WORDS", "12"))
+# System prompt wording: full, or compact for latency-critical deployments
+SYSTEM_PROMPT_VARIANT = os.getenv("SYSTEM_PROMPT_VARIANT", "full").lower()
+
+# Cache of LLM answers keyed on dialog state plus (similar) normalized user text
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() != "false"
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "500"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "3600"))
+LLM_CACHE_SIMILARITY = float(os.getenv("LLM_CACHE_SIMILARITY", "0.8"))
+LLM_CACHE_MAX_WORDS = int(os.getenv("LLM_CACHE_MAX_WORDS", "12"))
+
+# Session store limits (SESSION_REDIS_URL switches to the shared Redis backend)
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "")
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "1800"))
+SESSION_DISCONNECT_GRACE = float(os.getenv("SESSION_DISCONNECT_GRACE", "60"))
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "1000"))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "30"))
+
+# Upper bound for one streamed speech segment upload
+MAX_SEGMENT_UPLOAD_BYTES = int(os.getenv("MAX_SEGMENT_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+
+# Size of binary audio chunks streamed to the client
+AUDIO_CHUNK_SIZE = int(os.getenv("AUDIO_CHUNK_SIZE", "16384"))
+
+# Turn deadline: time from receiving a segment until the first reply audio is sent
+TURN_DEADLINE = float(os.getenv("TURN_DEADLINE", "6"))
+# A stage attempt with less time than this left is skipped rather than started
+MIN_ATTEMPT_SECONDS = float(os.getenv("MIN_ATTEMPT_SECONDS", "0.5"))
+
+# Sentences shorter than this are merged with the next one before TTS
+MIN_TTS_SENTENCE_CHARS = int(os.getenv("MIN_TTS_SENTENCE_CHARS", "20"))
+
+# Audio decoding settings (STT expects 16kHz mono PCM16)
+STT_SAMPLE_RATE = 16000
+
+# PCM preprocessing before STT: DC removal, high-pass (0 disables) and loudness normalization
+STT_HIGH_PASS_HZ = float(os.getenv("STT_HIGH_PASS_HZ", "80"))
+STT_TARGET_RMS_DBFS = float(os.getenv("STT_TARGET_RMS_DBFS", "-20"))
+STT_PEAK_DBFS = float(os.getenv("STT_PEAK_DBFS", "-1"))
+STT_MAX_GAIN_DB = float(os.getenv("STT_MAX_GAIN_DB", "20"))
+
+# STT upload codec: auto (FLAC once it has produced a transcript, falling back to WAV), flac, wav,
+# or webm (client bytes as-is)
+STT_UPLOAD_CODEC = os.getenv("STT_UPLOAD_CODEC", "auto").lower()
+# Status codes that may mean the STT endpoint does not accept an upload format.
+# 415 says so outright; 400/422 could also be bad audio, so they only count
+# once WAV of the same audio has gone through
+STT_CODEC_REJECTED_STATUSES = (400, 415, 422)
+STT_CODEC_UNSUPPORTED_STATUS = 415
+
+# Speech recognizer: aisha (batch upload per segment) or fake (local streaming stand-in).
+# A partial transcript unchanged for STT_STABLE_PARTIAL_MS lets the LLM start before finalization
+STT_PROVIDER = os.getenv("STT_PROVIDER", "aisha").lower()
+STT_EARLY_START = os.getenv("STT_EARLY_START", "true").lower() != "false"
+STT_STABLE_PARTIAL_MS = int(os.getenv("STT_STABLE_PARTIAL_MS", "300"))
+STT_FAKE_TRANSCRIPT = os.getenv("STT_FAKE_TRANSCRIPT", "Assalomu alaykum, kardiologga yozilmoqchiman")
+STT_FAKE_BYTES_PER_WORD = int(os.getenv("STT_FAKE_BYTES_PER_WORD", "4000"))
+STT_FAKE_FINAL_DELAY = float(os.getenv("STT_FAKE_FINAL_DELAY", "0.3"))
+
+# Server-side VAD on decoded audio (RMS thresholds are on the int16 scale, before normalization)
+VAD_ENABLED = os.getenv("VAD_ENABLED", "true").lower() != "false"
+VAD_FRAME_MS = int(os.getenv("VAD_FRAME_MS", "30"))
+VAD_MIN_RMS = float(os.getenv("VAD_MIN_RMS", "200"))
+VAD_NOISE_RATIO = float(os.getenv("VAD_NOISE_RATIO", "3.0"))
+VAD_MIN_SPEECH_MS = int(os.getenv("VAD_MIN_SPEECH_MS", "150"))
+VAD_PADDING_MS = int(os.getenv("VAD_PADDING_MS", "200"))
+
+# Warm ffmpeg fallback decoders (used when PyAV cannot parse a segment)
+FFMPEG_POOL_SIZE = int(os.getenv("FFMPEG_POOL_SIZE", "2"))
+FFMPEG_POOL_WAIT = float(os.getenv("FFMPEG_POOL_WAIT", "2.0"))
+FFMPEG_DECODE_TIMEOUT = float(os.getenv("FFMPEG_DECODE_TIMEOUT", "10"))
+
+
+class UpstreamUnavailable(requests.exceptions.ConnectionError):
+    """An upstream call was refused locally: circuit open or concurrency limit reached"""
+
+    def __init__(self, name, reason):
+        super().__init__(f"{name}: {reason}")
+        self.reason = reason
+
+
+class CircuitBreaker:
+    """Failure-rate circuit breaker over a sliding time window.
+
+    closed: calls flow and outcomes are recorded. Once CIRCUIT_MIN_CALLS calls
+    in the last CIRCUIT_WINDOW seconds fail at CIRCUIT_FAILURE_RATE or more,
+    the circuit opens and calls are refused for CIRCUIT_OPEN_SECONDS. It then
+    goes half-open and lets CIRCUIT_HALF_OPEN_PROBES probe calls through; a
+    successful probe closes it again, a failed one reopens it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._outcomes = deque()
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self.opens = 0
+        self.rejected = 0
+
+    def _trim(self, now):
+        while self._outcomes and self._outcomes[0][0] < now - CIRCUIT_WINDOW:
+            self._outcomes.popleft()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'open':
+                if time.time() - self.opened_at < CIRCUIT_OPEN_SECONDS:
+                    self.rejected += 1
+                    return False
+                self.state = 'half_open'
+            if self.state == 'half_open':
+                if self.probes_in_flight >= CIRCUIT_HALF_OPEN_PROBES:
+                    self.rejected += 1
+                    return False
+                self.probes_in_flight += 1
+            return True
+
+    def record(self, ok):
+        """Record a call outcome; ok=None releases the call without judging the upstream"""
+        now = time.time()
+        with self._lock:
+            if self.state == 'half_open':
+                self.probes_in_flight = max(0, self.probes_in_flight - 1)
+                if ok is None:
+                    return
+                if ok:
+                    self.state = 'closed'
+                    self._outcomes.clear()
+                else:
+                    self._open(now)
+                return
+            if self.state == 'open' or ok is None:
+                return
+            self._outcomes.append((now, ok))
+            self._trim(now)
+            failures = sum(1 for _, success in self._outcomes if not success)
+            if len(self._outcomes) >= CIRCUIT_MIN_CALLS and failures / len(self._outcomes) >= CIRCUIT_FAILURE_RATE:
+                self._open(now)
+
+    def _open(self, now):
+        self.state = 'open'
+        self.opened_at = now
+        self.opens += 1
+        self._outcomes.clear()
+
+    def stats(self):
+        with self._lock:
+            self._trim(time.time())
+            failures = sum(1 for _, success in self._outcomes if not success)
+            return {
+                'state': self.state,
+                'window_calls': len(self._outcomes),
+                'window_failures': failures,
+                'opens': self.opens,
+                'rejected': self.rejected
+            }
+
+
+class AIMDLimiter:
+    """Adaptive concurrency limit: additive increase on success, multiplicative decrease on failure.
+
+    Every success raises the limit by 1/limit (about +1 per limit's worth of
+    calls); every timeout or overload response cuts it by AIMD_BACKOFF. Calls
+    beyond the current limit are refused instead of queueing behind a slow
+    upstream.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.limit = float(CONCURRENCY_LIMIT_INITIAL)
+        self.in_flight = 0
+        self.rejected = 0
+
+    def acquire(self):
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, ok):
+        """Free a slot; ok=None (e.g. a cancelled call) leaves the limit unchanged"""
+        with self._lock:
+            self.in_flight -= 1
+            if ok is None:
+                return
+            if ok:
+                self.limit = min(CONCURRENCY_LIMIT_MAX, self.limit + 1.0 / self.limit)
+            else:
+                self.limit = max(CONCURRENCY_LIMIT_MIN, self.limit * AIMD_BACKOFF)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limit': round(self.limit, 2),
+                'in_flight': self.in_flight,
+                'rejected': self.rejected
+            }
+
+
+def is_upstream_failure(response):
+    """Responses that signal an overloaded or broken upstream (4xx are the caller's fault)"""
+    return response.status_code >= 500 or response.status_code == 429
+
+
+class UpstreamDeadlineExceeded(requests.exceptions.Timeout):
+    """An upstream call ran past its hard wall-clock deadline"""
+
+
+class UpstreamClient:
+    """Keep-alive HTTP session with a dedicated connection pool for one upstream.
+
+    requests' timeout only bounds each connect/read step, so a slow trickle of
+    bytes can hold a greenlet far longer. Every call here is additionally
+    bounded by an eventlet.Timeout, which makes the timeout a hard deadline.
+    """
+
+    def __init__(self, name, pool_size=UPSTREAM_POOL_SIZE):
+        self.name = name
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.pool_exhausted = 0
+        self.deadline_exceeded = 0
+        self.breaker = CircuitBreaker()
+        self.limiter = AIMDLimiter()
+
+    @contextmanager
+    def deadline(self, seconds, record_failure=True):
+        """Hard wall-clock limit for a block of work, e.g. reading a streamed body"""
+        timer = eventlet.Timeout(seconds)
+        try:
+            yield
+        except eventlet.Timeout as t:
+            if t is not timer:
+                raise
+            with self._lock:
+                self.deadline_exceeded += 1
+            # Streamed bodies are read after request() has recorded its outcome
+            if record_failure:
+                self.breaker.record(False)
+            raise UpstreamDeadlineExceeded(f"{self.name}: deadline of {seconds}s exceeded")
+        finally:
+            timer.cancel()
+
+    def request(self, method, url, timeout, **kwargs):
+        # Fail fast while the upstream is known to be down or saturated
+        if not self.breaker.allow():
+            raise UpstreamUnavailable(self.name, 'circuit open')
+        if not self.limiter.acquire():
+            self.breaker.record(None)
+            raise UpstreamUnavailable(self.name, 'concurrency limit reached')
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            # More concurrent calls than pooled connections: extras are not kept alive
+            if self.in_flight > self.pool_size:
+                self.pool_exhausted += 1
+        # Stays None if the call is killed (barge-in, lost hedge): no verdict on the upstream
+        ok = None
+        try:
+            with self.deadline(timeout, record_failure=False):
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            ok = not is_upstream_failure(response)
+            return response
+        except requests.exceptions.RequestException:
+            ok = False
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self.limiter.release(ok)
+            self.breaker.record(ok)
+
+    def post(self, url, timeout, **kwargs):
+        return self.request('POST', url, timeout, **kwargs)
+
+    def get(self, url, timeout, **kwargs):
+        return self.request('GET', url, timeout, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pool_size': self.pool_size,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'requests': self.requests,
+                'errors': self.errors,
+                'pool_exhausted': self.pool_exhausted,
+                'deadline_exceeded': self.deadline_exceeded,
+                'circuit': self.breaker.stats(),
+                'concurrency': self.limiter.stats()
+            }
+
+
+# One pool per upstream host (Aisha serves both STT and TTS)
+aisha_client = UpstreamClient('aisha')
+groq_client = UpstreamClient('groq')
+cdn_client = UpstreamClient('tts_cdn')
+upstream_clients = [aisha_client, groq_client, cdn_client]
+
+
+class HedgedCall:
+    """Race backup attempts against a slow or failed first attempt for one upstream step.
+
+    If the first attempt has not finished by the step's recent latency
+    percentile, a hedge is fired in parallel and the first success wins; the
+    loser is killed and its result discarded. A failed attempt is retried
+    straight away (speculative retry) instead of after a backoff sleep. Hedges
+    are capped at HEDGE_MAX_RATIO of calls so a slow upstream is not doubled.
+    """
+
+    def __init__(self, name, default_delay=HEDGE_DEFAULT_DELAY):
+        self.name = name
+        self.default_delay = default_delay
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=HEDGE_WINDOW)
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedges_capped = 0
+        self.retries = 0
+        self.failures = 0
+
+    def threshold(self):
+        """Delay before hedging: the recent latency percentile once enough samples exist"""
+        with self._lock:
+            samples = list(self._latencies)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return self.default_delay
+        return max(HEDGE_MIN_DELAY, float(np.percentile(samples, HEDGE_PERCENTILE)))
+
+    def _allow_hedge(self):
+        with self._lock:
+            if self.hedges < HEDGE_MAX_RATIO * self.calls:
+                self.hedges += 1
+                return True
+            self.hedges_capped += 1
+            return False
+
+    def run(self, fn, attempts=3, can_launch=lambda: True, discard=None):
+        """Return fn()'s first successful result, using up to `attempts` calls.
+
+        can_launch is checked before every extra attempt (e.g. the turn
+        budget) and discard receives results that lost the race.
+        """
+        with self._lock:
+            self.calls += 1
+        results = queue.Queue()
+        running = {}
+
+        launched = 0
+
+        def launch(kind):
+            nonlocal launched
+            attempt_id = launched
+            launched += 1
+            started = time.time()
+
+            def attempt():
+                try:
+                    results.put((attempt_id, True, fn(), time.time() - started))
+                except Exception as e:
+                    results.put((attempt_id, False, e, time.time() - started))
+
+            running[attempt_id] = (kind, eventlet.spawn(attempt))
+
+        launch('primary')
+        hedge_pending = HEDGE_ENABLED
+        last_error = None
+        try:
+            while running:
+                wait = self.threshold() if hedge_pending and len(running) == 1 and launched < attempts else None
+                try:
+                    attempt_id, ok, value, elapsed = results.get(timeout=wait)
+                except queue.Empty:
+                    hedge_pending = False
+                    if can_launch() and self._allow_hedge():
+                        print(f"{self.name}: no answer after {wait:.2f}s, hedging")
+                        launch('hedge')
+                    continue
+
+                kind, _ = running.pop(attempt_id)
+                if ok:
+                    with self._lock:
+                        self._latencies.append(elapsed)
+                        if kind == 'hedge':
+                            self.hedge_wins += 1
+                    return value
+
+                last_error = value
+                print(f"{self.name}: {kind} attempt failed: {value}")
+                # A locally refused call (circuit open, limit reached) would just be refused again
+                if (not running and launched < attempts and can_launch()
+                        and not isinstance(value, UpstreamUnavailable)):
+                    with self._lock:
+                        self.retries += 1
+                    launch('retry')
+        finally:
+            for _, gt in running.values():
+                gt.kill()
+            while discard is not None and not results.empty():
+                _, ok, value, _ = results.get()
+                if ok:
+                    discard(value)
+
+        with self._lock:
+            self.failures += 1
+        raise last_error
+
+    def stats(self):
+        threshold = self.threshold()
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'hedges': self.hedges,
+                'hedge_rate': round(self.hedges / self.calls, 3) if self.calls else 0.0,
+                'hedge_wins': self.hedge_wins,
+                'win_rate': round(self.hedge_wins / self.hedges, 3) if self.hedges else 0.0,
+                'hedges_capped': self.hedges_capped,
+                'retries': self.retries,
+                'failures': self.failures,
+                'threshold': round(threshold, 3),
+                'samples': len(self._latencies)
+            }
+
+
+# TTS synthesis and the CDN audio fetch are hedged independently
+tts_hedge = HedgedCall('tts')
+cdn_hedge = HedgedCall('tts_cdn')
+hedged_calls = [tts_hedge, cdn_hedge]
+
+
+# System prompt for Sofia, assembled from sections so a deployment can pick
+# the full or the compact wording of each
+PROMPT_PERSONA = """# Customer Service & Support Agent Prompt
 
 ## Identity & Purpose
 
@@ -77,8 +655,9 @@ You are Sofia, a hospital voice assistant for Real Medical Center. Your primary
 - Vary your sentence length and complexity to sound natural
 - Include occasional filler words like "actually" or "essentially" for authenticity
 - Speak at a moderate pace, slowing down for complex information
+"""
 
-Conversation Flow
+PROMPT_CONVERSATION_FLOW = """Conversation Flow
 
 Introduction
 
@@ -131,8 +710,9 @@ If the caller prefers not to book immediately:
 
 ### Closing
 End with: "Thank you for contacting Real Medical Center. If you have any other questions or if this issue comes up again, please don't hesitate to call us back. Have a great day!"
+"""
 
-## Response Guidelines
+PROMPT_GUIDELINES = """## Response Guidelines
 
 - Keep responses conversational and under 30 words when possible
 - Do not ask questions except "Do you have any more questions?" and keep responses concise and friendly.
@@ -161,8 +741,9 @@ End with: "Thank you for contacting Real Medical Center. If you have any other q
 ### Complex Requests
  - Break them into steps: "First, let's choose the specialty, then the time."
  - If specialized help is needed, offer to connect or schedule a callback.
+"""
 
-## Knowledge Base
+PROMPT_KNOWLEDGE_BASE = """## Knowledge Base
 
 ### Key Information
  - Location: Tashkent, Almazar district, Talabalar street, building 65 (say "oltmish beshinchi bino")
@@ -179,8 +760,9 @@ End with: "Thank you for contacting Real Medical Center. If you have any other q
  - Cannot give medical advice or diagnosis
  - Cannot guarantee clinical outcomes
  - If unsure, politely redirect or offer callback
+"""
 
-## Response Refinement
+PROMPT_CALL_MANAGEMENT = """## Response Refinement
 
 - Summarize clearly before confirming: "Cardiologist, tomorrow, at 2 p.m.—correct?"
 - For step-by-step instructions, number each step clearly and confirm completion before moving to the next
@@ -191,13 +773,14 @@ End with: "Thank you for contacting Real Medical Center. If you have any other q
 
 - If background noise interferes with communication: "I'm having a little trouble hearing you clearly. Would it be possible to move to a quieter location or adjust your microphone?"
 - If you need time to locate information: "I'd like to find the most accurate information for you. Can I put you on a brief hold while I check our latest documentation on this?"
-- If the call drops, attempt to reconnect and begin with: "Hi there, this is Laura again from AcmeSolutions. I apologize for the disconnection. Let's continue where we left off with [last topic]."
+- If the call drops, attempt to reconnect and begin with: "Hi there, this is Sofia again from Real Medical Center. I apologize for the disconnection. Let's continue where we left off with [last topic]."
 
-Remember that your ultimate goal is to resolve customer issues efficiently while creating a positive, supportive experience that reinforces their trust in AcmeSolutions.
+Remember that your ultimate goal is to resolve customer issues efficiently while creating a positive, supportive experience that reinforces their trust in Real Medical Center.
 
 Make sure that responses are short about 10 words. make sure they are consice and accurate.
+"""
 
-CRITICAL FORMATTING RULES:
+PROMPT_FORMATTING = """CRITICAL FORMATTING RULES:
 - ALWAYS write numbers as WORDS (letters), NEVER use digits
 - Examples:
   * "200,000 sums" → "ikki yuz ming so'm"
@@ -206,23 +789,941 @@ CRITICAL FORMATTING RULES:
   * "65" → "oltmish besh"
 - This applies to ALL numbers: prices, times, addresses, phone numbers, everything
 
-IMPORTANT: Always respond in Uzbek language."""
+IMPORTANT: Always respond in Uzbek language.
+"""
+
+PROMPT_PERSONA_COMPACT = """You are Sofia, the voice assistant of Real Medical Center. You help patients book, reschedule or cancel consultations, answer questions about the hospital, and collect contact details. Be friendly, patient and brief.
+"""
+
+PROMPT_CONVERSATION_FLOW_COMPACT = """Booking: ask for the specialty or doctor, then the date and time (offer up to three nearest options if unavailable), then full name, phone number and address. Right after collecting them, read the name and phone number back ("Ismingiz [name], telefon raqamingiz [phone number]. To'g'rimi?") and wait for confirmation; confirm the address the same way. Then restate specialty, date, time and fee and finalize.
+Cancel or reschedule: verify name and phone number, confirm the current appointment, make the change and restate it.
+Callback: collect and confirm name, phone number and address, then promise a call back.
+"""
+
+PROMPT_GUIDELINES_COMPACT = """Never repeat the greeting once the call has started. Give no medical advice; offer to book the right doctor instead. Show empathy to upset callers.
+"""
+
+PROMPT_KNOWLEDGE_BASE_COMPACT = """Facts: location Toshkent, Olmazar tumani, Talabalar ko'chasi, oltmish beshinchi bino. Consultation fee ikki yuz ming so'm. Slot length o'ttiz daqiqa. Timezone Asia/Tashkent. If unsure, offer a callback.
+"""
+
+PROMPT_CALL_MANAGEMENT_COMPACT = """If you cannot hear the caller, ask them to move somewhere quieter. Keep replies to about ten words.
+"""
+
+PROMPT_FORMATTING_COMPACT = """Write every number as Uzbek words, never digits (prices, times, addresses, phone numbers). Always respond in Uzbek.
+"""
+
+PROMPT_SECTIONS = [
+    ('persona', PROMPT_PERSONA, PROMPT_PERSONA_COMPACT),
+    ('conversation_flow', PROMPT_CONVERSATION_FLOW, PROMPT_CONVERSATION_FLOW_COMPACT),
+    ('guidelines', PROMPT_GUIDELINES, PROMPT_GUIDELINES_COMPACT),
+    ('knowledge_base', PROMPT_KNOWLEDGE_BASE, PROMPT_KNOWLEDGE_BASE_COMPACT),
+    ('call_management', PROMPT_CALL_MANAGEMENT, PROMPT_CALL_MANAGEMENT_COMPACT),
+    ('formatting', PROMPT_FORMATTING, PROMPT_FORMATTING_COMPACT),
+]
+
+
+def build_system_prompt(variant):
+    """Join the prompt sections in their 'full' or 'compact' wording.
+
+    The result depends only on the variant, never on the call or the clock,
+    so every Groq request starts with the same bytes and provider-side
+    prefix caching can reuse it; per-call context comes after it.
+    """
+    if variant not in ('full', 'compact'):
+        raise ValueError(f"Unknown SYSTEM_PROMPT_VARIANT: {variant}")
+    return '\n\n'.join((full if variant == 'full' else compact).strip() for _, full, compact in PROMPT_SECTIONS)
+
+
+SYSTEM_PROMPT = build_system_prompt(SYSTEM_PROMPT_VARIANT)
+
+
+def prompt_stats():
+    """Estimated token counts of the active system prompt, per section and for both variants"""
+    sections = {name: estimate_tokens((full if SYSTEM_PROMPT_VARIANT == 'full' else compact).strip())
+                for name, full, compact in PROMPT_SECTIONS}
+    return {
+        'variant': SYSTEM_PROMPT_VARIANT,
+        'tokens': estimate_tokens(SYSTEM_PROMPT),
+        'bytes': len(SYSTEM_PROMPT.encode('utf-8')),
+        'sha256': hashlib.sha256(SYSTEM_PROMPT.encode('utf-8')).hexdigest()[:16],
+        'sections': sections,
+        'full_tokens': estimate_tokens(build_system_prompt('full')),
+        'compact_tokens': estimate_tokens(build_system_prompt('compact'))
+    }
+
+SUMMARY_PROMPT = """You compress phone call transcripts between a hospital assistant and a patient.
+Write a short summary (under 80 words) of the conversation so far, merged with the previous summary.
+Keep every collected booking detail exactly as given: specialty or doctor, date and time, full name, phone number, address, and whether each was confirmed.
+Mention any open question the patient is still waiting on. Write in Uzbek."""
+
+def new_session_state():
+    return {
+        'call_id': uuid.uuid4().hex,
+        'latest_request_id': 0,
+        'cancel_before_id': 0,
+        'summary': '',
+        'summarizing': False,
+        'context_tokens': 0,
+        'booking': None
+    }
+
+
+class MemorySessionBackend:
+    """In-process session backend with idle TTL and LRU eviction.
+
+    Used for single-worker deployments and as the stand-in for the shared
+    backend in local runs. Records are kept in least-recently-used order,
+    expired sessions are swept lazily on access and the least recently used
+    session is evicted once max_sessions is reached.
+    """
+
+    def __init__(self, idle_ttl, max_sessions, sweep_interval):
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.sweep_interval = sweep_interval
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+        self.expired = 0
+        self.evicted = 0
+
+    def _record(self, session_id):
+        self._maybe_sweep()
+        with self._lock:
+            record = self._records.get(session_id)
+            if record is None:
+                record = {'history': [], 'state': new_session_state()}
+                self._records[session_id] = record
+                while len(self._records) > self.max_sessions:
+                    evicted_id, _ = self._records.popitem(last=False)
+                    self.evicted += 1
+                    print(f"Session store full, evicted least recently used session {evicted_id}")
+            else:
+                self._records.move_to_end(session_id)
+            record['expires_at'] = time.time() + self.idle_ttl
+            return record
+
+    def get_state(self, session_id):
+        return dict(self._record(session_id)['state'])
+
+    def peek_state(self, session_id):
+        """State without refreshing TTL or LRU order; None for unknown sessions"""
+        with self._lock:
+            record = self._records.get(session_id)
+            return None if record is None else dict(record['state'])
+
+    def update_state(self, session_id, **fields):
+        self._record(session_id)['state'].update(fields)
+
+    def raise_state(self, session_id, field, value):
+        """Raise a numeric state field to value if it is lower; returns the result"""
+        state = self._record(session_id)['state']
+        with self._lock:
+            state[field] = max(state[field], value)
+            return state[field]
+
+    def get_history(self, session_id):
+        return list(self._record(session_id)['history'])
+
+    def append_history(self, session_id, *messages):
+        self._record(session_id)['history'].extend(messages)
+
+    def trim_history(self, session_id, count):
+        """Drop the oldest count messages"""
+        del self._record(session_id)['history'][:count]
+
+    def replace_user_message(self, session_id, old, new):
+        """Rewrite the latest user message reading old; returns whether one was found"""
+        history = self._record(session_id)['history']
+        with self._lock:
+            for message in reversed(history):
+                if message['role'] == 'user' and message['content'] == old:
+                    message['content'] = new
+                    return True
+            return False
+
+    def reset(self, session_id):
+        with self._lock:
+            self._records.pop(session_id, None)
+        self._record(session_id)
+
+    def drop(self, session_id):
+        with self._lock:
+            self._records.pop(session_id, None)
+
+    def expire(self, session_id, seconds):
+        """Shorten the session's remaining lifetime to at most seconds"""
+        with self._lock:
+            record = self._records.get(session_id)
+            if record is not None:
+                record['expires_at'] = min(record['expires_at'], time.time() + seconds)
+
+    def session_ids(self):
+        with self._lock:
+            return list(self._records)
+
+    def _maybe_sweep(self):
+        now = time.time()
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        with self._lock:
+            expired = [session_id for session_id, record in self._records.items() if record['expires_at'] <= now]
+            for session_id in expired:
+                del self._records[session_id]
+            self.expired += len(expired)
+        if expired:
+            print(f"Session store expired {len(expired)} idle sessions")
+
+    def stats(self):
+        with self._lock:
+            approx_bytes = sum(
+                sum(len(m['content']) for m in r['history']) + len(r['state']['summary'])
+                for r in self._records.values()
+            )
+            return {
+                'backend': 'memory',
+                'active_sessions': len(self._records),
+                'max_sessions': self.max_sessions,
+                'approx_bytes': approx_bytes,
+                'expired': self.expired,
+                'evicted': self.evicted
+            }
+
+
+class RedisSessionBackend:
+    """Session backend on a Redis-compatible server, shared by every worker.
+
+    History is a list of JSON messages and state a hash of JSON values; both
+    keys carry the idle TTL, refreshed on access. A sorted set of last-access
+    times tracks active sessions so the least recently used ones can be
+    evicted once max_sessions is reached.
+    """
+
+    # Atomic "raise to at least value" for monotonic ids such as cancel_before_id
+    RAISE_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+local value = tonumber(ARGV[2])
+if value > current then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    current = value
+end
+return current
+"""
+
+    def __init__(self, url, idle_ttl, max_sessions, prefix='sofia'):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.idle_ttl = int(idle_ttl)
+        self.max_sessions = max_sessions
+        self.prefix = prefix
+        self.index_key = f"{prefix}:sessions"
+        self._raise = self.redis.register_script(self.RAISE_SCRIPT)
+        self.evicted = 0
+
+    def _keys(self, session_id):
+        return f"{self.prefix}:session:{session_id}:state", f"{self.prefix}:session:{session_id}:history"
+
+    def _touch(self, session_id):
+        state_key, history_key = self._keys(session_id)
+        now = time.time()
+        with self.redis.pipeline() as pipe:
+            pipe.expire(state_key, self.idle_ttl)
+            pipe.expire(history_key, self.idle_ttl)
+            pipe.zadd(self.index_key, {session_id: now})
+            pipe.execute()
+
+    def _create(self, session_id):
+        state_key, _ = self._keys(session_id)
+        state = new_session_state()
+        self.redis.hset(state_key, mapping={k: json.dumps(v) for k, v in state.items()})
+        self._touch(session_id)
+
+        # Forget sessions whose keys have expired, then enforce the session cap
+        self.redis.zremrangebyscore(self.index_key, '-inf', time.time() - self.idle_ttl)
+        overflow = self.redis.zcard(self.index_key) - self.max_sessions
+        if overflow > 0:
+            for evicted_id, _ in self.redis.zpopmin(self.index_key, overflow):
+                evicted_id = evicted_id.decode('utf-8')
+                self.redis.delete(*self._keys(evicted_id))
+                self.evicted += 1
+                print(f"Session store full, evicted least recently used session {evicted_id}")
+        return state
+
+    def get_state(self, session_id):
+        state_key, _ = self._keys(session_id)
+        raw = self.redis.hgetall(state_key)
+        if not raw:
+            return self._create(session_id)
+        self._touch(session_id)
+        return {k.decode('utf-8'): json.loads(v) for k, v in raw.items()}
+
+    def peek_state(self, session_id):
+        """State without refreshing TTL or recreating it; None for unknown or expired sessions"""
+        state_key, _ = self._keys(session_id)
+        raw = self.redis.hgetall(state_key)
+        if not raw:
+            return None
+        return {k.decode('utf-8'): json.loads(v) for k, v in raw.items()}
+
+    def update_state(self, session_id, **fields):
+        self.get_state(session_id)
+        state_key, _ = self._keys(session_id)
+        self.redis.hset(state_key, mapping={k: json.dumps(v) for k, v in fields.items()})
+
+    def raise_state(self, session_id, field, value):
+        self.get_state(session_id)
+        state_key, _ = self._keys(session_id)
+        return int(self._raise(keys=[state_key], args=[field, int(value)]))
+
+    def get_history(self, session_id):
+        self.get_state(session_id)
+        _, history_key = self._keys(session_id)
+        return [json.loads(m) for m in self.redis.lrange(history_key, 0, -1)]
+
+    def append_history(self, session_id, *messages):
+        self.get_state(session_id)
+        _, history_key = self._keys(session_id)
+        self.redis.rpush(history_key, *[json.dumps(m) for m in messages])
+        self.redis.expire(history_key, self.idle_ttl)
+
+    def trim_history(self, session_id, count):
+        _, history_key = self._keys(session_id)
+        self.redis.ltrim(history_key, count, -1)
+
+    def replace_user_message(self, session_id, old, new):
+        history = self.get_history(session_id)
+        _, history_key = self._keys(session_id)
+        for index in range(len(history) - 1, -1, -1):
+            message = history[index]
+            if message['role'] == 'user' and message['content'] == old:
+                self.redis.lset(history_key, index, json.dumps(dict(message, content=new)))
+                return True
+        return False
+
+    def reset(self, session_id):
+        self.redis.delete(*self._keys(session_id))
+        self._create(session_id)
+
+    def drop(self, session_id):
+        self.redis.delete(*self._keys(session_id))
+        self.redis.zrem(self.index_key, session_id)
+
+    def expire(self, session_id, seconds):
+        for key in self._keys(session_id):
+            self.redis.expire(key, int(seconds))
+
+    def session_ids(self):
+        return [s.decode('utf-8') for s in self.redis.zrange(self.index_key, 0, -1)]
+
+    def stats(self):
+        return {
+            'backend': 'redis',
+            'active_sessions': self.redis.zcard(self.index_key),
+            'max_sessions': self.max_sessions,
+            'evicted': self.evicted
+        }
+
+
+if SESSION_REDIS_URL:
+    sessions = RedisSessionBackend(SESSION_REDIS_URL, SESSION_IDLE_TTL, MAX_SESSIONS)
+    logger.info("Session backend: redis")
+else:
+    sessions = MemorySessionBackend(SESSION_IDLE_TTL, MAX_SESSIONS, SESSION_SWEEP_INTERVAL)
+    logger.info("Session backend: in-process memory")
+
+# Connection-local data: which sessions each socket drives, and streamed
+# segment uploads (a socket's chunks always reach the worker holding it)
+socket_sessions = {}
+segment_uploads = {}
+
+
+def is_request_cancelled(session_id, req_id):
+    return isinstance(req_id, int) and req_id < sessions.get_state(session_id)['cancel_before_id']
+
+
+def bind_socket(session_id):
+    """Remember that the current socket drives session_id (for disconnect cleanup)"""
+    socket_sessions.setdefault(request.sid, set()).add(session_id)
+
+
+def release_socket(sid):
+    """Cancel in-flight work of the socket's sessions and let them expire after a grace period"""
+    released = socket_sessions.pop(sid, set())
+    for session_id in released:
+        state = sessions.get_state(session_id)
+        cancel_before_id = sessions.raise_state(session_id, 'cancel_before_id', state['latest_request_id'] + 1)
+        cancel_scopes(session_id, cancel_before_id)
+        sessions.expire(session_id, SESSION_DISCONNECT_GRACE)
+        discard_segment_upload(session_id)
+    return sorted(released)
+
+
+def event_session_id(data):
+    """Session id sent by the client, falling back to the socket id (never a shared default)"""
+    return data.get('session_id') or request.sid
+
 
-# Store conversation history per session
-conversations = {}
-session_runtime = {}
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) without a tokenizer dependency"""
+    return len(text) // 4 + 1
 
-def get_session_state(session_id: str):
-    if session_id not in session_runtime:
-        session_runtime[session_id] = {
-            'latest_request_id': 0,
-            'cancel_before_id': 0
+
+def message_tokens(message):
+    # Role and framing overhead per chat message
+    return estimate_tokens(message['content']) + 4
+
+
+def build_context(session_id):
+    """Rolling summary plus the most recent turns that fit the history token budget"""
+    state = sessions.get_state(session_id)
+    history = sessions.get_history(session_id)
+
+    window = []
+    used = 0
+    for message in reversed(history):
+        cost = message_tokens(message)
+        # Always keep the latest message even if it alone exceeds the budget
+        if window and used + cost > HISTORY_TOKEN_BUDGET:
+            break
+        window.append(message)
+        used += cost
+    window.reverse()
+
+    context = []
+    if state['summary']:
+        summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {state['summary']}"}
+        context.append(summary_message)
+        used += message_tokens(summary_message)
+
+    sessions.update_state(session_id, context_tokens=used)
+    return context + window
+
+
+def maybe_summarize(session_id):
+    """Fold older turns into the rolling summary in the background once history outgrows the budget"""
+    state = sessions.get_state(session_id)
+    history = sessions.get_history(session_id)
+    if state['summarizing'] or len(history) <= KEEP_RECENT_MESSAGES:
+        return
+    if sum(message_tokens(m) for m in history) <= HISTORY_TOKEN_BUDGET:
+        return
+    sessions.update_state(session_id, summarizing=True)
+    eventlet.spawn(summarize_history, session_id, state, history)
+
+
+def summarize_history(session_id, state, history):
+    """Replace all but the last KEEP_RECENT_MESSAGES messages with an LLM-written summary"""
+    try:
+        cutoff = len(history) - KEEP_RECENT_MESSAGES
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in history[:cutoff])
+        data = {
+            "model": SUMMARY_MODEL,
+            "messages": [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"Previous summary: {state['summary'] or 'none'}\n\nConversation:\n{transcript}"}
+            ],
+            "temperature": 0.2,
+            "max_tokens": 200
+        }
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {GROQ_API_KEY}"
+        }
+        response = groq_client.post(GROQ_URL, timeout=LLM_TIMEOUT, headers=headers, json=data)
+        response.raise_for_status()
+        summary = response.json()['choices'][0]['message']['content'].strip()
+        if not summary:
+            print(f"Summary Error ({session_id}): empty summary, keeping history")
+            return
+
+        # The call may have been restarted while the summary was being written
+        if sessions.get_state(session_id)['call_id'] != state['call_id']:
+            return
+        sessions.trim_history(session_id, cutoff)
+        sessions.update_state(session_id, summary=summary)
+        print(f"Summarized {cutoff} messages for session {session_id} ({estimate_tokens(summary)} tokens)")
+    except Exception as e:
+        print(f"Summary Error ({session_id}): {str(e)}")
+    finally:
+        # A restarted call starts with its own flag, which is not ours to clear
+        if sessions.get_state(session_id)['call_id'] == state['call_id']:
+            sessions.update_state(session_id, summarizing=False)
+
+
+def append_segment_chunk(session_id, segment_id, seq, chunk, on_partial=None):
+    """Buffer one streamed recorder chunk and feed it to the segment's recognition stream.
+
+    A new segment_id replaces the old buffer.
+    """
+    upload = segment_uploads.get(session_id)
+    if upload is None or upload['segment_id'] != segment_id:
+        discard_segment_upload(session_id)
+        upload = {
+            'segment_id': segment_id,
+            'chunks': {},
+            'size': 0,
+            'stream': stt_recognizer.open_stream(on_partial),
+            'fed': 0
         }
-    return session_runtime[session_id]
+        segment_uploads[session_id] = upload
+
+    if upload['size'] + len(chunk) > MAX_SEGMENT_UPLOAD_BYTES:
+        print(f"Segment {segment_id} for session {session_id} exceeds upload limit, dropping chunk")
+        return False
+    upload['chunks'][seq] = chunk
+    upload['size'] += len(chunk)
+    # Recognizers need audio in recorder order; hold back chunks that arrived early
+    while upload['fed'] in upload['chunks']:
+        upload['stream'].feed(upload['chunks'][upload['fed']])
+        upload['fed'] += 1
+    return True
+
+
+def take_segment_upload(session_id, segment_id):
+    """Remove the streamed segment, returning its recognition stream or None if it never arrived"""
+    upload = segment_uploads.get(session_id)
+    if upload is None or upload['segment_id'] != segment_id:
+        return None
+    del segment_uploads[session_id]
+    stream = upload['stream']
+    # Chunks after a gap in seq were held back; the segment is complete now
+    for seq in sorted(upload['chunks']):
+        if seq >= upload['fed']:
+            stream.feed(upload['chunks'][seq])
+    return stream
+
+
+def discard_segment_upload(session_id):
+    """Drop the session's pending segment upload and close its recognition stream"""
+    upload = segment_uploads.pop(session_id, None)
+    if upload is not None:
+        upload['stream'].close()
+
+
+class TurnBudgetExceeded(Exception):
+    """Raised when a stage has no time left in the turn's deadline budget"""
+
+    def __init__(self, stage):
+        super().__init__(f"turn budget exhausted at {stage}")
+        self.stage = stage
+
+
+class TurnBudgetStats:
+    """Counts turns and where their deadline budget ran out"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.exhausted = {}
+        self.retries_skipped = 0
+
+    def record_turn(self):
+        with self._lock:
+            self.turns += 1
+
+    def record_exhausted(self, stage):
+        with self._lock:
+            self.exhausted[stage] = self.exhausted.get(stage, 0) + 1
+
+    def record_retry_skipped(self):
+        with self._lock:
+            self.retries_skipped += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'turns': self.turns,
+                'exhausted': dict(self.exhausted),
+                'retries_skipped': self.retries_skipped
+            }
+
+
+turn_budget_stats = TurnBudgetStats()
+
+
+class TurnBudget:
+    """Deadline shared by STT, LLM and TTS until the first reply audio is on its way.
+
+    Each stage call gets its usual timeout capped by the time left; once less
+    than MIN_ATTEMPT_SECONDS remains the stage is skipped and the turn
+    degrades (e.g. to a text-only reply).
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.deadline = time.time() + seconds
+        turn_budget_stats.record_turn()
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.time())
+
+    def timeout(self, stage, default):
+        left = self.remaining()
+        if left < MIN_ATTEMPT_SECONDS:
+            turn_budget_stats.record_exhausted(stage)
+            raise TurnBudgetExceeded(stage)
+        return min(default, left)
+
+    def can_retry(self):
+        """Whether an extra attempt (retry or hedge) could still start with a usable timeout"""
+        if self.remaining() >= MIN_ATTEMPT_SECONDS:
+            return True
+        turn_budget_stats.record_retry_skipped()
+        return False
+
+
+def stage_timeout(budget, stage, default):
+    return default if budget is None else budget.timeout(stage, default)
+
+
+def decode_audio(audio_data, sample_rate=STT_SAMPLE_RATE):
+    """Decode WebM/Opus bytes in memory into mono PCM16 samples"""
+    resampler = av.AudioResampler(format='s16', layout='mono', rate=sample_rate)
+    chunks = []
+    with av.open(io.BytesIO(audio_data), mode='r') as container:
+        stream = container.streams.audio[0]
+        for frame in container.decode(stream):
+            for resampled in resampler.resample(frame):
+                chunks.append(resampled.to_ndarray().reshape(-1))
+    # Flush samples still buffered inside the resampler
+    for resampled in resampler.resample(None):
+        chunks.append(resampled.to_ndarray().reshape(-1))
+
+    if not chunks:
+        return np.zeros(0, dtype=np.int16)
+    return np.concatenate(chunks).astype(np.int16, copy=False)
+
+
+def resample_audio(samples, source_rate, target_rate=STT_SAMPLE_RATE):
+    """Linear-interpolation resampling of a mono buffer"""
+    if source_rate == target_rate or samples.size == 0:
+        return samples
+    duration = samples.size / source_rate
+    positions = np.arange(int(round(duration * target_rate)), dtype=np.float64) * (source_rate / target_rate)
+    return np.interp(positions, np.arange(samples.size), samples).astype(np.float32)
+
+
+def high_pass(samples, cutoff, sample_rate=STT_SAMPLE_RATE):
+    """Remove content below cutoff Hz in the frequency domain (rumble, handling noise)"""
+    spectrum = np.fft.rfft(samples)
+    freqs = np.fft.rfftfreq(samples.size, 1.0 / sample_rate)
+    # Half-octave cosine ramp up to the cutoff instead of a brick wall, to avoid ringing
+    ramp = np.clip((np.log2(np.maximum(freqs, 1e-6) / cutoff) + 0.5) / 0.5, 0.0, 1.0)
+    spectrum *= 0.5 - 0.5 * np.cos(np.pi * ramp)
+    return np.fft.irfft(spectrum, n=samples.size).astype(np.float32)
+
+
+def condition_audio(samples, sample_rate=STT_SAMPLE_RATE):
+    """Resample to STT_SAMPLE_RATE, remove DC offset and optionally high-pass, as float32"""
+    audio = resample_audio(samples.astype(np.float32), sample_rate)
+    if audio.size == 0:
+        return audio
+    audio -= audio.mean()
+    if STT_HIGH_PASS_HZ > 0:
+        audio = high_pass(audio, STT_HIGH_PASS_HZ)
+    return audio
+
+
+def normalize_loudness(audio):
+    """Scale towards STT_TARGET_RMS_DBFS without the peak passing STT_PEAK_DBFS, as PCM16.
+
+    Replaces a fixed input gain: quiet speakers are boosted (up to
+    STT_MAX_GAIN_DB) and loud ones are no longer clipped.
+    """
+    if audio.size == 0:
+        return audio.astype(np.int16)
+    rms = float(np.sqrt(np.mean(np.square(audio, dtype=np.float64))))
+    peak = float(np.max(np.abs(audio)))
+    if rms == 0.0:
+        return audio.astype(np.int16)
+    full_scale = 32767.0
+    gain = full_scale * 10 ** (STT_TARGET_RMS_DBFS / 20) / rms
+    gain = min(gain, full_scale * 10 ** (STT_PEAK_DBFS / 20) / peak, 10 ** (STT_MAX_GAIN_DB / 20))
+    return np.clip(audio * gain, -32768, 32767).astype(np.int16)
+
+
+def pcm_to_wav(samples, sample_rate=STT_SAMPLE_RATE):
+    """Wrap mono PCM16 samples in a WAV container"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def pcm_to_flac(samples, sample_rate=STT_SAMPLE_RATE):
+    """Losslessly encode mono PCM16 samples as FLAC in memory"""
+    buffer = io.BytesIO()
+    with av.open(buffer, mode='w', format='flac') as container:
+        stream = container.add_stream('flac', rate=sample_rate)
+        stream.layout = 'mono'
+        frame = av.AudioFrame.from_ndarray(samples.reshape(1, -1), format='s16', layout='mono')
+        frame.sample_rate = sample_rate
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buffer.getvalue()
+
+
+# Upload codecs by preference for STT_UPLOAD_CODEC=auto; WAV always works
+STT_CODEC_PREFERENCE = ['flac', 'wav']
+# Codecs the STT endpoint refused during this process' lifetime
+rejected_stt_codecs = set()
+# Codecs that have produced a transcript; until then an empty one is retried as WAV
+confirmed_stt_codecs = set()
+
+
+def stt_upload_codecs():
+    """Codecs to try for the next upload, ending with the WAV fallback"""
+    if STT_UPLOAD_CODEC == 'auto':
+        codecs = STT_CODEC_PREFERENCE
+    else:
+        codecs = [STT_UPLOAD_CODEC, 'wav']
+    chosen = [codec for codec in codecs if codec not in rejected_stt_codecs]
+    return chosen if 'wav' in chosen else chosen + ['wav']
+
+
+def encode_stt_upload(codec, samples, original):
+    """Return the (filename, payload, mime type) multipart file for one upload codec.
+
+    'webm' passes the client's original WebM/Opus bytes through untouched, so
+    silence trimming and normalization do not reach the upload.
+    """
+    if codec == 'webm':
+        return 'voice_input.webm', original, 'audio/webm'
+    if codec == 'flac':
+        return 'voice_input.flac', pcm_to_flac(samples), 'audio/flac'
+    return 'voice_input.wav', pcm_to_wav(samples), 'audio/wav'
+
+
+class SttUploadStats:
+    """Per-codec upload sizes and STT latency, with the WAV size each upload replaced"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.codecs = {}
+
+    def _entry(self, codec):
+        return self.codecs.setdefault(codec, {
+            'uploads': 0,
+            'bytes': 0,
+            'wav_bytes': 0,
+            'latency_total': 0.0,
+            'rejected': 0
+        })
+
+    def record(self, codec, size, wav_size, latency):
+        with self._lock:
+            entry = self._entry(codec)
+            entry['uploads'] += 1
+            entry['bytes'] += size
+            entry['wav_bytes'] += wav_size
+            entry['latency_total'] += latency
+
+    def record_rejected(self, codec):
+        with self._lock:
+            self._entry(codec)['rejected'] += 1
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for codec, entry in self.codecs.items():
+                uploads = entry['uploads']
+                result[codec] = {
+                    'uploads': uploads,
+                    'rejected': entry['rejected'],
+                    'bytes': entry['bytes'],
+                    'avg_bytes': entry['bytes'] // uploads if uploads else 0,
+                    'size_vs_wav': round(entry['bytes'] / entry['wav_bytes'], 3) if entry['wav_bytes'] else None,
+                    'avg_latency': round(entry['latency_total'] / uploads, 3) if uploads else None
+                }
+            return {
+                'mode': STT_UPLOAD_CODEC,
+                'rejected_codecs': sorted(rejected_stt_codecs),
+                'confirmed_codecs': sorted(confirmed_stt_codecs),
+                'codecs': result
+            }
+
+
+stt_upload_stats = SttUploadStats()
+
+
+class VadStats:
+    """Counts what server-side VAD kept away from STT"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.segments = 0
+        self.dropped = 0
+        self.trimmed = 0
+        self.wav_bytes_saved = 0
+
+    def record(self, total_samples, kept_samples):
+        with self._lock:
+            self.segments += 1
+            if kept_samples == 0:
+                self.dropped += 1
+            elif kept_samples < total_samples:
+                self.trimmed += 1
+            # Measured as PCM16 WAV, two bytes per sample; compressed uploads
+            # (FLAC) save less, see size_vs_wav in the stt_upload stats
+            self.wav_bytes_saved += 2 * (total_samples - kept_samples)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'segments': self.segments,
+                'dropped': self.dropped,
+                'stt_calls_saved': self.dropped,
+                'trimmed': self.trimmed,
+                'wav_bytes_saved': self.wav_bytes_saved
+            }
+
+
+vad_stats = VadStats()
+
+
+def detect_speech(samples, sample_rate=STT_SAMPLE_RATE):
+    """Energy-based VAD: return the (start, end) sample range holding speech, or None.
+
+    Frames are VAD_FRAME_MS long. A frame is speech when its RMS is above both
+    VAD_MIN_RMS and VAD_NOISE_RATIO times the segment's noise floor (its 10th
+    percentile frame RMS). Segments with less than VAD_MIN_SPEECH_MS of speech
+    are rejected; otherwise the range is padded by VAD_PADDING_MS each side.
+    """
+    frame = int(sample_rate * VAD_FRAME_MS / 1000)
+    count = samples.size // frame
+    if count == 0:
+        return None
+    frames = samples[:count * frame].astype(np.float32).reshape(count, frame)
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    threshold = max(VAD_MIN_RMS, float(np.percentile(rms, 10)) * VAD_NOISE_RATIO)
+    speech = np.flatnonzero(rms > threshold)
+    if speech.size * VAD_FRAME_MS < VAD_MIN_SPEECH_MS:
+        return None
+    padding = int(sample_rate * VAD_PADDING_MS / 1000)
+    start = max(0, speech[0] * frame - padding)
+    end = min(samples.size, (speech[-1] + 1) * frame + padding)
+    return int(start), int(end)
+
+
+def trim_silence(samples):
+    """Drop non-speech segments and cut leading/trailing silence; None means nothing to send"""
+    if not VAD_ENABLED:
+        return samples
+    bounds = detect_speech(samples)
+    if bounds is None:
+        vad_stats.record(samples.size, 0)
+        return None
+    start, end = bounds
+    vad_stats.record(samples.size, end - start)
+    return samples[start:end]
+
+
+class FfmpegWorkerPool:
+    """Pool of pre-spawned ffmpeg decoders fed over stdin/stdout pipes.
+
+    ffmpeg exits once its input stream ends, so each worker handles one
+    segment; a replacement is spawned in the background right after a worker
+    is taken, keeping process startup off the request path.
+    """
+
+    COMMAND = [
+        'ffmpeg',
+        '-loglevel', 'error',
+        '-i', 'pipe:0',
+        '-vn',
+        '-acodec', 'pcm_s16le',
+        '-ar', str(STT_SAMPLE_RATE),
+        '-ac', '1',
+        '-f', 's16le',
+        'pipe:1'
+    ]
+
+    def __init__(self, size, acquire_timeout):
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self._idle = queue.Queue()
+        self._slots = threading.BoundedSemaphore(size)
+        for _ in range(size):
+            self._spawn()
+
+    def _spawn(self):
+        try:
+            proc = subprocess.Popen(
+                self.COMMAND,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+        except OSError as e:
+            print(f"FFmpeg pool: could not start worker: {e}")
+            return None
+        self._idle.put(proc)
+        return proc
+
+    def _take_worker(self):
+        while True:
+            try:
+                proc = self._idle.get_nowait()
+            except queue.Empty:
+                # Pool drained faster than it refilled; start one inline
+                if self._spawn() is None:
+                    return None
+                continue
+            if proc.poll() is None:
+                return proc
+            print(f"FFmpeg pool: discarding dead worker (exit code {proc.returncode})")
+
+    def decode(self, audio_data, timeout=FFMPEG_DECODE_TIMEOUT):
+        """Decode audio bytes to mono PCM16 samples, or None on failure/saturation"""
+        # Backpressure: never run more than `size` conversions at once
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            print("FFmpeg pool saturated, rejecting conversion")
+            return None
+        try:
+            proc = self._take_worker()
+            if proc is None:
+                return None
+            eventlet.spawn_n(self._spawn)
+
+            # The green subprocess raises its own TimeoutExpired class, so bound
+            # communicate() with an eventlet timer instead of its timeout argument
+            timer = eventlet.Timeout(timeout)
+            try:
+                pcm, stderr = proc.communicate(input=audio_data)
+            except eventlet.Timeout as t:
+                if t is not timer:
+                    raise
+                proc.kill()
+                proc.wait()
+                print(f"FFmpeg pool: conversion timed out after {timeout}s")
+                return None
+            finally:
+                timer.cancel()
+
+            if proc.returncode != 0:
+                print(f"FFmpeg pool conversion error: {stderr.decode('utf-8', 'replace')}")
+                return None
+            return np.frombuffer(pcm, dtype='<i2')
+        finally:
+            self._slots.release()
+
+
+if FFMPEG_POOL_SIZE > 0 and shutil.which('ffmpeg'):
+    ffmpeg_pool = FfmpegWorkerPool(FFMPEG_POOL_SIZE, FFMPEG_POOL_WAIT)
+    logger.info(f"FFmpeg fallback pool started with {FFMPEG_POOL_SIZE} workers")
+else:
+    ffmpeg_pool = None
+    logger.info("FFmpeg fallback pool disabled")
 
 
-def speech_to_text(audio_data):
-    """Convert speech to text using Aisha API"""
+def speech_to_text(audio_data, budget=None):
+    """Convert speech to text using Aisha API within the turn budget"""
     try:
         print(f"Received audio data: {len(audio_data)} bytes")
 
@@ -231,89 +1732,88 @@ def speech_to_text(audio_data):
             print("Audio data too small, likely empty")
             return None
 
-        # Save input audio (webm) to temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.webm') as temp_input:
-            temp_input.write(audio_data)
-            temp_input_path = temp_input.name
-
-        # Convert webm to wav using ffmpeg
-        temp_output_path = temp_input_path.replace('.webm', '.wav')
-
+        # Decode webm/opus to 16kHz mono PCM in memory (no temp files, no ffmpeg process)
         try:
-            # Robust FFmpeg conversion for WebM to WAV
-            result = subprocess.run([
-                'ffmpeg',
-                '-loglevel', 'error',  # Only show errors
-                '-i', temp_input_path,
-                '-vn',  # No video
-                '-acodec', 'pcm_s16le',  # PCM 16-bit little-endian
-                '-ar', '16000',  # Sample rate 16kHz
-                '-ac', '1',  # Mono audio
-                '-af', 'volume=2.0',  # Volume boost
-                '-f', 'wav',  # Force WAV format
-                '-y',  # Overwrite output
-                temp_output_path
-            ], check=True, capture_output=True, text=True)
-            print(f"FFmpeg conversion successful")
-        except subprocess.CalledProcessError as e:
-            print(f"FFmpeg conversion error: {e.stderr}")
-            # Try alternative approach without volume filter
-            try:
-                result = subprocess.run([
-                    'ffmpeg',
-                    '-loglevel', 'error',
-                    '-i', temp_input_path,
-                    '-vn',
-                    '-acodec', 'pcm_s16le',
-                    '-ar', '16000',
-                    '-ac', '1',
-                    '-f', 'wav',
-                    '-y',
-                    temp_output_path
-                ], check=True, capture_output=True, text=True)
-                print(f"FFmpeg conversion successful (fallback)")
-            except subprocess.CalledProcessError as e2:
-                print(f"FFmpeg fallback also failed: {e2.stderr}")
-                # If ffmpeg fails completely, clean up and return None
-                if os.path.exists(temp_input_path):
-                    os.unlink(temp_input_path)
+            samples = decode_audio(audio_data)
+        except (av.error.FFmpegError, IndexError, ValueError) as e:
+            print(f"Audio decoding error: {e}")
+            samples = ffmpeg_pool.decode(audio_data) if ffmpeg_pool else None
+            if samples is None:
                 return None
+            print("Audio decoded by ffmpeg pool (fallback)")
 
-        # Check converted file size
-        converted_size = os.path.getsize(temp_output_path)
-        print(f"Converted audio size: {converted_size} bytes")
+        if samples.size == 0:
+            print("Decoded audio is empty")
+            return None
+
+        # DC offset and rumble would otherwise look like speech energy to the VAD
+        audio = condition_audio(samples)
+        speech = trim_silence(audio)
+        if speech is None:
+            print("VAD: No speech in segment, skipping STT")
+            return None
+        if speech.size < audio.size:
+            print(f"VAD: Trimmed {audio.size - speech.size} of {audio.size} samples of silence")
+
+        samples = normalize_loudness(speech)
+        wav_size = samples.nbytes + 44  # PCM16 payload plus the WAV header
 
         headers = {
             'x-api-key': AISHA_API_KEY
         }
+        data = {
+            'title': 'voice_input',
+            'has_diarization': 'false',
+            'language': 'uz'
+        }
 
-        with open(temp_output_path, 'rb') as audio_file:
-            files = {
-                'audio': audio_file,
-            }
-            data = {
-                'title': 'voice_input',
-                'has_diarization': 'false',
-                'language': 'uz'
-            }
-
-            response = requests.post(
+        suspected = []  # codecs refused with an ambiguous status for this audio
+        silent = []  # unconfirmed codecs that came back with an empty transcript
+        for codec in stt_upload_codecs():
+            try:
+                upload = encode_stt_upload(codec, samples, audio_data)
+            except (av.error.FFmpegError, ValueError) as e:
+                print(f"STT: Could not encode {codec} upload: {e}")
+                continue
+            print(f"STT: Uploading {len(upload[1])} bytes as {codec} (WAV would be {wav_size})")
+
+            started = time.time()
+            response = aisha_client.post(
                 STT_URL,
+                timeout=stage_timeout(budget, 'stt', STT_TIMEOUT),
                 headers=headers,
-                files=files,
-                data=data,
-                timeout=12  # slightly higher for Render network
+                files={'audio': upload},
+                data=data
             )
+            if codec != 'wav' and response.status_code in STT_CODEC_REJECTED_STATUSES:
+                print(f"STT: Endpoint rejected {codec} upload ({response.status_code}), falling back")
+                stt_upload_stats.record_rejected(codec)
+                if response.status_code == STT_CODEC_UNSUPPORTED_STATUS:
+                    rejected_stt_codecs.add(codec)
+                else:
+                    suspected.append(codec)
+                continue
             response.raise_for_status()
+            stt_upload_stats.record(codec, len(upload[1]), wav_size, time.time() - started)
 
             result = response.json()
             text = result.get('text', '') or result.get('transcript', '') or result.get('transcription', '')
-
-        # Clean up temp files
-        if os.path.exists(temp_input_path):
-            os.unlink(temp_input_path)
-        if os.path.exists(temp_output_path) and temp_output_path != temp_input_path:
-            os.unlink(temp_output_path)
+            if codec != 'wav':
+                if text.strip():
+                    confirmed_stt_codecs.add(codec)
+                elif codec not in confirmed_stt_codecs:
+                    # VAD already dropped silent segments, so an empty transcript
+                    # may mean the endpoint accepts the format but cannot read it
+                    print(f"STT: Empty transcript from unconfirmed {codec} upload, retrying as WAV")
+                    stt_upload_stats.record_rejected(codec)
+                    silent.append(codec)
+                    continue
+            elif suspected or (silent and text.strip()):
+                # The same audio went through as WAV, so the codec was the problem
+                disabled = suspected + (silent if text.strip() else [])
+                print(f"STT: Disabling {', '.join(disabled)} uploads")
+                rejected_stt_codecs.update(disabled)
+            break
 
         return text
     except Exception as e:
@@ -324,135 +1824,1417 @@ def speech_to_text(audio_data):
         return None
 
 
-def get_llm_response(user_message, session_id):
-    """Get response from Groq LLM"""
+class SttStreamStats:
+    """Partial transcripts emitted and how often the LLM started on a stable partial"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.streams = 0
+        self.partials = 0
+        self.early_starts = 0
+        self.early_mismatches = 0
+        self.finalize_total = 0.0
+        self.finalized = 0
+
+    def record_stream(self):
+        with self._lock:
+            self.streams += 1
+
+    def record_partial(self):
+        with self._lock:
+            self.partials += 1
+
+    def record_early_start(self):
+        with self._lock:
+            self.early_starts += 1
+
+    def record_final(self, latency, early_text=None, final_text=None):
+        with self._lock:
+            self.finalized += 1
+            self.finalize_total += latency
+            if early_text is not None and (final_text or '').strip() != early_text.strip():
+                self.early_mismatches += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'provider': STT_PROVIDER,
+                'streams': self.streams,
+                'partials': self.partials,
+                'early_starts': self.early_starts,
+                'early_mismatches': self.early_mismatches,
+                'avg_finalize': round(self.finalize_total / self.finalized, 3) if self.finalized else None
+            }
+
+
+stt_stream_stats = SttStreamStats()
+
+
+class RecognitionStream:
+    """One speech segment flowing into a recognizer, chunk by chunk.
+
+    Providers implement finalize(); streaming ones also call _set_partial()
+    as hypotheses arrive. finish() returns the transcript the turn should use.
+    """
+
+    def __init__(self, on_partial=None):
+        self.on_partial = on_partial
+        self.chunks = []
+        self.partial = ''
+        self.partial_at = None
+        self.final_check = None
+        stt_stream_stats.record_stream()
+
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+
+    def audio(self):
+        return b''.join(self.chunks)
+
+    def close(self):
+        """Release provider resources for a segment that will never be finished"""
+
+    def finalize(self, budget=None):
+        raise NotImplementedError
+
+    def _set_partial(self, text):
+        if not text or text == self.partial:
+            return
+        self.partial = text
+        self.partial_at = time.time()
+        stt_stream_stats.record_partial()
+        if self.on_partial:
+            self.on_partial(text)
+
+    def stable_partial(self):
+        """The partial transcript once it has not changed for STT_STABLE_PARTIAL_MS"""
+        if not self.partial or time.time() - self.partial_at < STT_STABLE_PARTIAL_MS / 1000:
+            return None
+        return self.partial
+
+    def finish(self, budget=None):
+        """Final transcript, or a stable partial so the LLM can start without waiting for it.
+
+        After an early start the final transcript is still produced in the
+        background; final_transcript() waits for it so the caller can correct
+        the recorded turn. The reply itself was already built on the partial.
+        """
+        stable = self.stable_partial() if STT_EARLY_START else None
+        if stable is None:
+            started = time.time()
+            text = self.finalize(budget)
+            stt_stream_stats.record_final(time.time() - started)
+            return text
+
+        # Finalize off the critical path, to correct the turn and measure how often the early start was wrong
+        stt_stream_stats.record_early_start()
+        self.final_check = eventlet.spawn(self._check_final, stable)
+        return stable
+
+    def final_transcript(self):
+        """Final transcript after an early start (waiting for it), or None"""
+        return None if self.final_check is None else self.final_check.wait()
+
+    def _check_final(self, early_text):
+        started = time.time()
+        try:
+            text = self.finalize()
+        except Exception as e:
+            print(f"STT: Finalize after early start failed: {e}")
+            return None
+        stt_stream_stats.record_final(time.time() - started, early_text, text)
+        return text
+
+
+class BatchRecognitionStream(RecognitionStream):
+    """Buffers the segment and uploads it whole once it has ended (no partials)"""
+
+    def finalize(self, budget=None):
+        return speech_to_text(self.audio(), budget)
+
+
+class FakeRecognitionStream(RecognitionStream):
+    """Reveals a scripted transcript word by word as audio bytes arrive"""
+
+    def __init__(self, transcript, bytes_per_word, final_delay, on_partial=None):
+        super().__init__(on_partial)
+        self.words = transcript.split()
+        self.bytes_per_word = bytes_per_word
+        self.final_delay = final_delay
+        self.size = 0
+
+    def feed(self, chunk):
+        super().feed(chunk)
+        self.size += len(chunk)
+        self._set_partial(' '.join(self.words[:self.size // self.bytes_per_word]))
+
+    def finalize(self, budget=None):
+        eventlet.sleep(self.final_delay)
+        return ' '.join(self.words) if self.size else ''
+
+
+class BatchRecognizer:
+    """Aisha STT: one upload per finished segment through speech_to_text"""
+
+    def open_stream(self, on_partial=None):
+        return BatchRecognitionStream(on_partial)
+
+
+class FakeStreamingRecognizer:
+    """Local stand-in for a streaming STT provider, for development and tests"""
+
+    def __init__(self, transcript=STT_FAKE_TRANSCRIPT, bytes_per_word=STT_FAKE_BYTES_PER_WORD,
+                 final_delay=STT_FAKE_FINAL_DELAY):
+        self.transcript = transcript
+        self.bytes_per_word = bytes_per_word
+        self.final_delay = final_delay
+
+    def open_stream(self, on_partial=None):
+        return FakeRecognitionStream(self.transcript, self.bytes_per_word, self.final_delay, on_partial)
+
+
+STT_PROVIDERS = {
+    'aisha': BatchRecognizer,
+    'fake': FakeStreamingRecognizer
+}
+stt_recognizer = STT_PROVIDERS[STT_PROVIDER]()
+
+
+def correct_early_transcript(session_id, stream, early_text):
+    """Once the final transcript of an early-started turn is in, fix the recorded user line.
+
+    Returns the corrected text, or None when the turn did not start early or
+    the final matched. The assistant reply already given stays as it was.
+    """
+    final = stream.final_transcript()
+    if not final or final.strip() == early_text.strip():
+        return None
+    if not sessions.replace_user_message(session_id, early_text, final):
+        return None
+    print(f"STT: Corrected early transcript ({session_id}): '{early_text}' -> '{final}'")
+    return final
+
+
+def transcribe_segment(audio_data=None, stream=None, budget=None):
+    """Transcript for a finished segment, whether it was streamed in or uploaded whole"""
+    if stream is None:
+        stream = stt_recognizer.open_stream()
+        stream.feed(audio_data)
+    return stream.finish(budget)
+
+
+class SentenceSplitter:
+    """Accumulate streamed text and cut it into sentences for TTS"""
+
+    BOUNDARY = re.compile(r'(?<=[.!?…])\s+')
+
+    def __init__(self, min_chars=MIN_TTS_SENTENCE_CHARS):
+        self.min_chars = min_chars
+        self._buffer = ''
+
+    def feed(self, text):
+        """Add streamed text, returning any sentences that are now complete"""
+        self._buffer += text
+        pieces = self.BOUNDARY.split(self._buffer)
+        # The last piece has no boundary after it yet
+        self._buffer = pieces.pop()
+
+        sentences = []
+        pending = ''
+        for piece in pieces:
+            pending = f"{pending} {piece}".strip()
+            if len(pending) >= self.min_chars:
+                sentences.append(pending)
+                pending = ''
+        if pending:
+            self._buffer = f"{pending} {self._buffer}"
+        return sentences
+
+    def flush(self):
+        """Return whatever text is left once the stream has ended"""
+        rest = self._buffer.strip()
+        self._buffer = ''
+        return rest
+
+
+def iter_stream_deltas(response, usage=None):
+    """Yield content deltas from an OpenAI-compatible server-sent event stream.
+
+    Token usage reported in the stream is copied into the usage dict if given.
+    """
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith('data:'):
+            continue
+        payload = line[len('data:'):].strip()
+        if payload == '[DONE]':
+            break
+        chunk = json.loads(payload)
+        reported = chunk.get('usage') or (chunk.get('x_groq') or {}).get('usage')
+        if reported and usage is not None:
+            usage.update(reported)
+        choices = chunk.get('choices') or []
+        if not choices:
+            continue
+        delta = choices[0].get('delta', {}).get('content')
+        if delta:
+            yield delta
+
+
+def normalize_utterance(text):
+    """Lowercase, unify apostrophe variants and drop punctuation for matching"""
+    text = re.sub(r"[ʻʼ’‘`´]", "'", text.lower())
+    return ' '.join(re.sub(r"[^\w' ]+", ' ', text).split())
+
+
+class FaqRouter:
+    """Keyword/regex intent classifier answering fixed FAQ turns without the LLM.
+
+    A turn is answered only when it is short, matches exactly one intent and
+    does not look like a booking, cancellation or reschedule request; anything
+    else goes to the LLM. Answers are in STATIC_PHRASES, so their audio is
+    synthesized at warm-up and served from the TTS cache.
+    """
+
+    BLOCKLIST = re.compile(r"\b(yozil\w*|band qil\w*|bekor\w*|ko'chir\w*|o'zgartir\w*)")
+
+    def __init__(self, intents):
+        self.intents = [(name, re.compile(pattern), answer) for name, pattern, answer in intents]
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.hits = {}
+
+    def match(self, text):
+        """Return (intent, answer) for a confident match, else None"""
+        normalized = normalize_utterance(text)
+        if not FAQ_ROUTER_ENABLED or len(normalized.split()) > FAQ_MAX_WORDS or self.BLOCKLIST.search(normalized):
+            return None
+        matches = [(name, answer) for name, pattern, answer in self.intents if pattern.search(normalized)]
+        return matches[0] if len(matches) == 1 else None
+
+    def answer(self, user_text, session_id, on_sentence=None, follow_up=None):
+        """Answer an FAQ turn (recording it in the history), or return None for the LLM.
+
+        follow_up replaces FAQ_FOLLOW_UP_TEXT, e.g. to ask again for a booking detail.
+        """
+        match = self.match(user_text)
+        with self._lock:
+            self.turns += 1
+            if match:
+                self.hits[match[0]] = self.hits.get(match[0], 0) + 1
+        if match is None:
+            return None
+        intent, answer = match
+        print(f"FAQ router: '{user_text}' -> {intent}")
+        sentences = [answer] + (follow_up or [FAQ_FOLLOW_UP_TEXT])
+        reply = ' '.join(sentences)
+        sessions.append_history(session_id, {"role": "user", "content": user_text},
+                                {"role": "assistant", "content": reply})
+        maybe_summarize(session_id)
+        if on_sentence:
+            for sentence in sentences:
+                on_sentence(sentence)
+        return reply
+
+    def stats(self):
+        with self._lock:
+            hits = sum(self.hits.values())
+            return {
+                'turns': self.turns,
+                'hits': hits,
+                'hit_rate': round(hits / self.turns, 3) if self.turns else 0.0,
+                'by_intent': dict(self.hits)
+            }
+
+
+faq_router = FaqRouter(FAQ_INTENTS)
+
+
+UZBEK_ONES = ['nol', 'bir', 'ikki', 'uch', "to'rt", 'besh', 'olti', 'yetti', 'sakkiz', "to'qqiz"]
+UZBEK_TENS = ['', "o'n", 'yigirma', "o'ttiz", 'qirq', 'ellik', 'oltmish', 'yetmish', 'sakson', "to'qson"]
+
+
+def number_to_words(n):
+    """Spell a non-negative integer below one million in Uzbek"""
+    if n == 0:
+        return UZBEK_ONES[0]
+    words = []
+    if n >= 1000:
+        words += ([] if n // 1000 == 1 else [number_to_words(n // 1000)]) + ['ming']
+        n %= 1000
+    if n >= 100:
+        words += ([] if n // 100 == 1 else [UZBEK_ONES[n // 100]]) + ['yuz']
+        n %= 100
+    if n >= 10:
+        words.append(UZBEK_TENS[n // 10])
+        n %= 10
+    if n:
+        words.append(UZBEK_ONES[n])
+    return ' '.join(words)
+
+
+def spell_numbers(text):
+    """Replace digit runs with Uzbek words (TTS reads words more reliably than digits)"""
+    return re.sub(r'\d{1,5}', lambda m: number_to_words(int(m.group())), text)
+
+
+def spell_phone(digits):
+    """Read a phone number back digit by digit, in groups of two or three"""
+    groups = re.findall(r'\d{1,3}', digits[:-4]) + re.findall(r'\d{2}', digits[-4:]) if len(digits) > 4 else [digits]
+    return ', '.join(' '.join(UZBEK_ONES[int(d)] for d in group) for group in groups)
+
+
+class BookingStats:
+    """Bookings started/finished and how many of their turns fell through to FAQ/LLM"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'started': 0, 'completed': 0, 'cancelled': 0, 'templated_turns': 0, 'free_form_turns': 0}
+
+    def record(self, event):
+        with self._lock:
+            self.counts[event] += 1
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        turns = counts['templated_turns'] + counts['free_form_turns']
+        counts['free_form_share'] = round(counts['free_form_turns'] / turns, 3) if turns else 0.0
+        return counts
+
+
+booking_stats = BookingStats()
+
+
+def booking_active(booking):
+    return bool(booking) and booking.get('slot') is not None
+
+
+class BookingFlow:
+    """Per-session booking state machine: specialty -> time -> name -> phone -> address -> confirm.
+
+    The state lives in the session store under 'booking'. Slot answers,
+    read-backs and confirmations are handled here from templates (their
+    fixed sentences are in STATIC_PHRASES and so come from the TTS cache);
+    anything else (questions, unclear answers) returns None and goes to the
+    LLM, which then only sees the current slot and the last few turns.
+    """
+
+    SLOTS = ['specialty', 'time', 'name', 'phone', 'address']
+    # Contact details are read back and confirmed one by one
+    READ_BACK = {'name': "Ismingiz {value}.", 'phone': "Telefon raqamingiz {value}.", 'address': "Manzilingiz {value}."}
+
+    START = re.compile(r"\b(yozil\w*|qabul\w*|band qil\w*)")
+    CANCEL = re.compile(r"\bbekor\b|\bbekor qil\w*|\bkerak emas\b")
+    YES = re.compile(r"^(ha|xa|haa|albatta|mayli|to'g'ri|togri|tasdiqlayman|bo'ladi)\b")
+    # Checked before YES, so that "to'g'ri emas" is a no
+    NO = re.compile(r"\b(yo'q|yoq|noto'g'ri|notogri|xato|unday emas|bunday emas|emas)\b")
+    QUESTION = re.compile(r"\b(qancha|qayer\w*|nima\w*|qanday|necha|nega)\b")
+    SPECIALTIES = re.compile(r"\b(kardiolog|nevrolog|terapevt|pediatr|stomatolog|lor|okulist|ginekolog|urolog|"
+                             r"dermatolog|endokrinolog|travmatolog|xirurg|jarroh)\w*")
+    TIME_WORDS = re.compile(r"\d|\b(bugun|ertaga|indinga|dushanba|seshanba|chorshanba|payshanba|juma|shanba|"
+                            r"yakshanba|soat|ertalab|kechqurun|tushdan|kunduzi)\w*")
+    AMEND = [('name', re.compile(r"\bism")), ('phone', re.compile(r"\b(telefon|raqam)")),
+             ('address', re.compile(r"\bmanzil")), ('time', re.compile(r"\b(vaqt|soat|kun|sana)")),
+             ('specialty', re.compile(r"\b(shifokor|mutaxassis|doktor|vrach)"))]
+
+    def answer(self, user_text, session_id, on_sentence=None):
+        """Handle a booking turn from templates, or return None to let FAQ/LLM answer it"""
+        if not BOOKING_FLOW_ENABLED:
+            return None
+        booking = sessions.get_state(session_id).get('booking')
+        normalized = normalize_utterance(user_text)
+        if not booking_active(booking):
+            if not self.START.search(normalized) or self.CANCEL.search(normalized) or self.QUESTION.search(normalized):
+                return None
+            booking = {'slot': 'specialty', 'slots': {}, 'pending': None}
+            booking_stats.record('started')
+            sentences = []
+            specialty = self.SPECIALTIES.search(normalized)
+            if specialty:
+                booking['slots']['specialty'] = specialty.group(1)
+                booking['slot'] = 'time'
+            sentences.append(BOOKING_QUESTIONS[booking['slot']])
+            return self._reply(session_id, user_text, booking, sentences, on_sentence)
+
+        if self.CANCEL.search(normalized):
+            booking_stats.record('cancelled')
+            return self._reply(session_id, user_text, None, [BOOKING_CANCELLED_TEXT], on_sentence)
+
+        sentences = self._advance(booking, user_text, normalized)
+        if sentences is None:
+            booking_stats.record('free_form_turns')
+            return None
+        if booking['slot'] is None:
+            booking_stats.record('completed')
+        return self._reply(session_id, user_text, booking, sentences, on_sentence)
+
+    def _advance(self, booking, user_text, normalized):
+        """Apply the user's turn to the booking; return the reply sentences or None"""
+        slot, pending = booking['slot'], booking['pending']
+        if pending is not None:
+            if self.NO.search(normalized):
+                booking['pending'] = None
+                booking['slots'].pop(slot, None)
+                return [BOOKING_REPEAT_TEXT, BOOKING_QUESTIONS[slot]]
+            if self.YES.search(normalized):
+                booking['pending'] = None
+                return self._next_question(booking)
+            return None
+
+        if slot == 'confirm':
+            if self.NO.search(normalized):
+                booking['slot'] = 'amend'
+                return [BOOKING_AMEND_TEXT]
+            if self.YES.search(normalized):
+                booking['slot'] = None
+                return [BOOKING_DONE_TEXT]
+            return None
+
+        if slot == 'amend':
+            for name, pattern in self.AMEND:
+                if pattern.search(normalized):
+                    booking['slots'].pop(name, None)
+                    booking['slot'] = name
+                    return [BOOKING_QUESTIONS[name]]
+            return None
+
+        if '?' in user_text or self.QUESTION.search(normalized):
+            return None
+        value = self._extract(slot, user_text, normalized)
+        if value is None:
+            return None
+        booking['slots'][slot] = value
+        if slot in self.READ_BACK:
+            booking['pending'] = slot
+            return self._read_back(slot, value)
+        return self._next_question(booking)
+
+    def _read_back(self, slot, value):
+        spoken = spell_phone(value) if slot == 'phone' and value.isdigit() else spell_numbers(value)
+        return [self.READ_BACK[slot].format(value=spoken), BOOKING_CHECK_TEXT]
+
+    def reprompt(self, session_id):
+        """The question a booking in progress is waiting on, or None without one"""
+        booking = sessions.get_state(session_id).get('booking')
+        if not BOOKING_FLOW_ENABLED or not booking_active(booking):
+            return None
+        slot = booking['slot']
+        if booking['pending'] is not None:
+            return self._read_back(slot, booking['slots'][slot])
+        if slot == 'confirm':
+            return [BOOKING_CONFIRM_TEXT]
+        if slot == 'amend':
+            return [BOOKING_AMEND_TEXT]
+        return [BOOKING_QUESTIONS[slot]]
+
+    def _extract(self, slot, user_text, normalized):
+        words = normalized.split()
+        if slot == 'specialty':
+            match = self.SPECIALTIES.search(normalized)
+            if match:
+                return match.group(1)
+            return user_text.strip(' .!').lower() if len(words) <= 4 else None
+        if slot == 'time':
+            return user_text.strip(' .!').lower() if self.TIME_WORDS.search(normalized) and len(words) <= 10 else None
+        if slot == 'name':
+            name = re.sub(r"^(mening )?(ismim|ism familiyam|ismi sharifim)\s*", '', normalized)
+            name = re.sub(r"\s*(bo'ladi|deb yozing)$", '', name)
+            if not name or re.search(r'\d', name) or len(name.split()) > 4:
+                return None
+            return ' '.join(word.capitalize() for word in name.split())
+        if slot == 'phone':
+            digits = re.sub(r'\D', '', user_text)
+            if len(digits) >= 7:
+                return digits
+            return user_text.strip(' .!') if not digits and 5 <= len(words) <= 15 else None
+        if slot == 'address':
+            return user_text.strip(' .!') if 1 < len(words) <= 15 else None
+        return None
+
+    def _next_question(self, booking):
+        for slot in self.SLOTS:
+            if slot not in booking['slots']:
+                booking['slot'] = slot
+                return [BOOKING_QUESTIONS[slot]]
+        booking['slot'] = 'confirm'
+        slots = booking['slots']
+        return [BOOKING_SUMMARY_TEXT.format(specialty=slots['specialty'], time=spell_numbers(slots['time'])),
+                BOOKING_FEE_TEXT, BOOKING_CONFIRM_TEXT]
+
+    @staticmethod
+    def _reply(session_id, user_text, booking, sentences, on_sentence):
+        sessions.update_state(session_id, booking=booking)
+        booking_stats.record('templated_turns')
+        reply = ' '.join(sentences)
+        sessions.append_history(session_id, {"role": "user", "content": user_text},
+                                {"role": "assistant", "content": reply})
+        maybe_summarize(session_id)
+        if on_sentence:
+            for sentence in sentences:
+                on_sentence(sentence)
+        return reply
+
+
+booking_flow = BookingFlow()
+
+
+def build_booking_context(session_id, booking):
+    """Booking directive plus only the last few turns, instead of the full rolling context"""
+    slot = booking['slot']
+    collected = ', '.join(f"{name}: {value}" for name, value in booking['slots'].items()) or 'nothing yet'
+    directive = {
+        "role": "system",
+        "content": f"A booking is in progress. Collected so far: {collected}. "
+                   f"Currently waiting for: {BOOKING_SLOT_DESCRIPTIONS[slot]}. "
+                   f"Answer the caller briefly, then ask for that again."
+    }
+    window = sessions.get_history(session_id)[-BOOKING_CONTEXT_TURNS:]
+    context = [directive] + window
+    sessions.update_state(session_id, context_tokens=sum(message_tokens(m) for m in context))
+    return context
+
+
+def text_trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def dialog_fingerprint(history, state):
+    """Compact dialog state: the assistant line being answered (or none, at call start),
+    plus the session's rolling summary and any booking details collected so far"""
+    last_reply = next((m['content'] for m in reversed(history) if m['role'] == 'assistant'), '')
+    booking = state.get('booking') or {}
+    collected = json.dumps(booking.get('slots') or {}, sort_keys=True, ensure_ascii=False)
+    key = '\n'.join([normalize_utterance(last_reply), state.get('summary') or '', collected])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+def word_stems(text):
+    """Five-letter stems of the longer words, so Karimov also matches Karimova"""
+    return {word[:5] for word in normalize_utterance(text).split() if len(word) >= 4}
+
+
+class ResponseCache:
+    """LLM answers keyed on dialog-state fingerprint plus normalized user text.
+
+    Lookups only consider entries with the same fingerprint, so an answer is
+    reused only in reply to the same assistant line. Within it the closest
+    stored utterance by character-trigram Jaccard similarity wins if it
+    reaches LLM_CACHE_SIMILARITY. Entries expire after LLM_CACHE_TTL seconds
+    and the least recently used are evicted beyond LLM_CACHE_MAX_ENTRIES.
+    Turns with digits (phone numbers, dates) or more than LLM_CACHE_MAX_WORDS
+    words are never cached, nor are answers that echo a word of the caller's
+    utterance (a name, a complaint) since they would leak to other callers.
+    """
+
+    def __init__(self, max_entries=LLM_CACHE_MAX_ENTRIES, ttl=LLM_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.echo_skipped = 0
+        self.hit_age_total = 0.0
+        self.hit_age_max = 0.0
+
+    @staticmethod
+    def cacheable(text):
+        normalized = normalize_utterance(text)
+        return bool(normalized) and not re.search(r'\d', normalized) and len(normalized.split()) <= LLM_CACHE_MAX_WORDS
+
+    def get(self, fingerprint, text):
+        if not LLM_CACHE_ENABLED or not self.cacheable(text):
+            return None
+        normalized = normalize_utterance(text)
+        grams = text_trigrams(normalized)
+        now = time.time()
+        with self._lock:
+            best_key, best_score = None, 0.0
+            for key, entry in list(self._entries.items()):
+                if now - entry['created'] > self.ttl:
+                    del self._entries[key]
+                    self.expired += 1
+                    continue
+                if key[0] != fingerprint:
+                    continue
+                if key[1] == normalized:
+                    best_key, best_score = key, 1.0
+                    break
+                union = grams | entry['grams']
+                score = len(grams & entry['grams']) / len(union) if union else 0.0
+                if score > best_score:
+                    best_key, best_score = key, score
+            if best_key is None or best_score < LLM_CACHE_SIMILARITY:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            entry = self._entries[best_key]
+            age = now - entry['created']
+            self.hits += 1
+            self.similar_hits += best_score < 1.0
+            self.hit_age_total += age
+            self.hit_age_max = max(self.hit_age_max, age)
+            return entry['answer']
+
+    def put(self, fingerprint, text, answer):
+        if not LLM_CACHE_ENABLED or not answer or not self.cacheable(text):
+            return
+        normalized = normalize_utterance(text)
+        key = (fingerprint, normalized)
+        with self._lock:
+            if word_stems(text) & word_stems(answer):
+                self.echo_skipped += 1
+                return
+            self._entries[key] = {'answer': answer, 'grams': text_trigrams(normalized), 'created': time.time()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'similar_hits': self.similar_hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'echo_skipped': self.echo_skipped,
+                'avg_hit_age': round(self.hit_age_total / self.hits, 1) if self.hits else None,
+                'max_hit_age': round(self.hit_age_max, 1)
+            }
+
+
+response_cache = ResponseCache()
+
+
+def replay_cached_response(answer, on_sentence):
+    """Hand a cached answer to on_sentence split the way a streamed one would be"""
+    splitter = SentenceSplitter()
+    for sentence in splitter.feed(answer):
+        on_sentence(sentence)
+    tail = splitter.flush()
+    if tail:
+        on_sentence(tail)
+
+
+class ModelStats:
+    """Per-model call counts, latency and token usage, plus why turns were routed where"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.models = {}
+        self.reasons = {}
+        self.escalations = 0
+
+    def record_route(self, reason):
+        with self._lock:
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+
+    def record_escalation(self):
+        with self._lock:
+            self.escalations += 1
+
+    def record_call(self, model, ok, latency, first_sentence=None, usage=None):
+        with self._lock:
+            entry = self.models.setdefault(model, {
+                'calls': 0,
+                'errors': 0,
+                'latencies': deque(maxlen=200),
+                'first_sentence_total': 0.0,
+                'first_sentence_count': 0,
+                'prompt_tokens': 0,
+                'completion_tokens': 0
+            })
+            entry['calls'] += 1
+            if not ok:
+                entry['errors'] += 1
+                return
+            entry['latencies'].append(latency)
+            if first_sentence is not None:
+                entry['first_sentence_total'] += first_sentence
+                entry['first_sentence_count'] += 1
+            usage = usage or {}
+            entry['prompt_tokens'] += usage.get('prompt_tokens', 0)
+            entry['completion_tokens'] += usage.get('completion_tokens', 0)
+
+    def stats(self):
+        with self._lock:
+            models = {}
+            for model, entry in self.models.items():
+                latencies = list(entry['latencies'])
+                models[model] = {
+                    'calls': entry['calls'],
+                    'errors': entry['errors'],
+                    'median_latency': round(float(np.median(latencies)), 3) if latencies else None,
+                    'avg_first_sentence': (round(entry['first_sentence_total'] / entry['first_sentence_count'], 3)
+                                           if entry['first_sentence_count'] else None),
+                    'prompt_tokens': entry['prompt_tokens'],
+                    'completion_tokens': entry['completion_tokens']
+                }
+            return {
+                'routing': LLM_ROUTING,
+                'models': models,
+                'routes': dict(self.reasons),
+                'escalations': self.escalations
+            }
+
+
+model_stats = ModelStats()
+
+# Booking and change requests, and assistant lines asking for or reading back details
+BOOKING_REQUEST = re.compile(r"\b(yozil\w*|band qil\w*|bekor\w*|ko'chir\w*|o'zgartir\w*|qabul\w*)")
+BOOKING_DETAIL_PROMPT = re.compile(r"\b(to'g'rimi|ism\w*|telefon\w*|raqam\w*|manzil\w*|sana\w*|qaysi (kun|vaqt|soat))")
+
+
+def choose_model(user_message, history, in_booking=False):
+    """Pick the model for a turn: (model, reason).
+
+    Short turns outside the booking flow (greetings, thanks, yes/no) go to
+    the fast model. Long turns, turns with numbers, booking requests and
+    replies to a detail question or read-back go to the large model, where
+    accuracy matters most, as do free-form turns in an active booking.
+    """
+    if LLM_ROUTING == 'fast':
+        return LLM_FAST_MODEL, 'forced'
+    if LLM_ROUTING != 'tiered':
+        return LLM_LARGE_MODEL, 'forced'
+
+    normalized = normalize_utterance(user_message)
+    last_reply = next((m['content'] for m in reversed(history) if m['role'] == 'assistant'), '')
+    if in_booking:
+        return LLM_LARGE_MODEL, 'booking_flow'
+    if len(normalized.split()) > LLM_ESCALATE_WORDS:
+        return LLM_LARGE_MODEL, 'long_turn'
+    if re.search(r'\d', normalized):
+        return LLM_LARGE_MODEL, 'numbers'
+    if BOOKING_REQUEST.search(normalized):
+        return LLM_LARGE_MODEL, 'booking_request'
+    if BOOKING_DETAIL_PROMPT.search(normalize_utterance(last_reply)):
+        return LLM_LARGE_MODEL, 'booking_details'
+    return LLM_FAST_MODEL, 'short_turn'
+
+
+def stream_completion(model, messages, on_sentence=None, budget=None):
+    """Stream one Groq chat completion, handing each finished sentence to on_sentence"""
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {GROQ_API_KEY}"
+    }
+
+    data = {
+        "model": model,
+        "messages": messages,
+        "temperature": 0.7,
+        "max_tokens": 150,
+        "stream": True,
+        "stream_options": {"include_usage": True}
+    }
+
+    splitter = SentenceSplitter()
+    parts = []
+    usage = {}
+    started = time.time()
+    first_sentence_at = None
+
+    def emit(sentence):
+        nonlocal first_sentence_at
+        if first_sentence_at is None:
+            first_sentence_at = time.time() - started
+        if on_sentence:
+            on_sentence(sentence)
+
+    try:
+        first_sentence_timeout = stage_timeout(budget, 'llm', LLM_TIMEOUT)
+        # One hard deadline for the whole completion, streamed body included
+        with groq_client.deadline(LLM_TIMEOUT):
+            first_sentence = eventlet.Timeout(first_sentence_timeout)
+            response = None
+            try:
+                response = groq_client.post(GROQ_URL, timeout=first_sentence_timeout, headers=headers, json=data, stream=True)
+                if not response.ok:
+                    print(f"Response status: {response.status_code}")
+                response.raise_for_status()
+                for delta in iter_stream_deltas(response, usage):
+                    parts.append(delta)
+                    for sentence in splitter.feed(delta):
+                        first_sentence.cancel()
+                        emit(sentence)
+            except eventlet.Timeout as t:
+                if t is not first_sentence:
+                    raise
+                turn_budget_stats.record_exhausted('llm')
+                raise TurnBudgetExceeded('llm')
+            finally:
+                first_sentence.cancel()
+                if response is not None:
+                    response.close()
+
+        tail = splitter.flush()
+        if tail:
+            emit(tail)
+    except Exception:
+        model_stats.record_call(model, False, time.time() - started)
+        raise
+
+    latency = time.time() - started
+    model_stats.record_call(model, True, latency, first_sentence_at, usage)
+    print(f"LLM {model}: {latency:.2f}s total, first sentence "
+          f"{'-' if first_sentence_at is None else f'{first_sentence_at:.2f}s'}, "
+          f"tokens {usage.get('prompt_tokens', '?')} in / {usage.get('completion_tokens', '?')} out")
+    return ''.join(parts).strip()
+
+
+def get_llm_response(user_message, session_id, on_sentence=None, budget=None):
+    """Get response from Groq LLM, streaming each finished sentence to on_sentence.
+
+    The turn budget bounds the wait for the first sentence; the rest of the
+    stream only has to finish within LLM_TIMEOUT. Answers found in the
+    response cache are replayed without calling Groq; otherwise choose_model
+    picks the fast or the large model, and a fast-model failure before any
+    sentence was emitted is retried on the large model.
+    """
     try:
-        # Get or create conversation history for this session
-        if session_id not in conversations:
-            conversations[session_id] = []
+        history = sessions.get_history(session_id)
+        state = sessions.get_state(session_id)
+        booking = state.get('booking')
+        # Mid-booking answers depend on the collected slots, not just the last line
+        cacheable = not booking_active(booking)
+        fingerprint = dialog_fingerprint(history, state)
+        cached = response_cache.get(fingerprint, user_message) if cacheable else None
+        if cached is not None:
+            print(f"LLM: Response cache hit for '{user_message[:50]}'")
+            sessions.append_history(session_id, {"role": "user", "content": user_message},
+                                    {"role": "assistant", "content": cached})
+            maybe_summarize(session_id)
+            if on_sentence:
+                replay_cached_response(cached, on_sentence)
+            return cached
 
         # Add user message to history
-        conversations[session_id].append({"role": "user", "content": user_message})
+        sessions.append_history(session_id, {"role": "user", "content": user_message})
 
         # Prepare messages for API
-        messages = [{"role": "system", "content": SYSTEM_PROMPT}] + conversations[session_id]
+        if booking_active(booking):
+            context = build_booking_context(session_id, booking)
+        else:
+            context = build_context(session_id)
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}] + context
+        print(f"LLM context ({session_id}): {sessions.get_state(session_id)['context_tokens']} history tokens")
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {GROQ_API_KEY}"
-        }
+        model, reason = choose_model(user_message, history, booking_active(booking))
+        model_stats.record_route(reason)
+        print(f"LLM route ({session_id}): {model} ({reason})")
 
-        data = {
-            "model": "llama-3.3-70b-versatile",
-            "messages": messages,
-            "temperature": 0.7,
-            "max_tokens": 150
-        }
+        spoken = []
 
-        response = requests.post(GROQ_URL, headers=headers, json=data)
-        response.raise_for_status()
+        def emit(sentence):
+            spoken.append(sentence)
+            if on_sentence:
+                on_sentence(sentence)
 
-        result = response.json()
-        assistant_message = result['choices'][0]['message']['content']
+        try:
+            assistant_message = stream_completion(model, messages, emit, budget)
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            # Escalate a failed fast-model turn, unless the caller already heard part of it
+            if model == LLM_LARGE_MODEL or spoken:
+                raise
+            print(f"LLM {model} failed ({e}), escalating to {LLM_LARGE_MODEL}")
+            model_stats.record_escalation()
+            assistant_message = stream_completion(LLM_LARGE_MODEL, messages, emit, budget)
+        if not assistant_message and model != LLM_LARGE_MODEL:
+            print(f"LLM {model} returned nothing, escalating to {LLM_LARGE_MODEL}")
+            model_stats.record_escalation()
+            assistant_message = stream_completion(LLM_LARGE_MODEL, messages, emit, budget)
 
         # Add assistant response to history
-        conversations[session_id].append({"role": "assistant", "content": assistant_message})
+        sessions.append_history(session_id, {"role": "assistant", "content": assistant_message})
+        maybe_summarize(session_id)
+        if cacheable:
+            response_cache.put(fingerprint, user_message, assistant_message)
 
         return assistant_message
-    except KeyError as e:
-        print(f"LLM KeyError: {str(e)}")
+    except (KeyError, ValueError) as e:
+        print(f"LLM stream parse error: {str(e)}")
         print(f"Session ID: {session_id}")
-        print(f"Response: {result if 'result' in locals() else 'No result'}")
         return "Kechirasiz, javob berishda muammo yuz berdi."
     except Exception as e:
         print(f"LLM Error: {str(e)}")
-        if 'response' in locals():
-            print(f"Response status: {response.status_code}")
-            print(f"Response content: {response.text}")
         return "Kechirasiz, xatolik yuz berdi."
 
 
-def text_to_speech(text, is_greeting=False):
-    """Convert text to speech using Aisha API with retry logic"""
-    max_retries = 3  # More retries for greetings
+class TTSCache:
+    """Content-addressed cache of synthesized audio with an LRU memory tier and optional disk tier"""
+
+    def __init__(self, max_bytes, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir or None
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key(text, model=TTS_MODEL, speed=TTS_SPEED, mood=TTS_MOOD, language=TTS_LANGUAGE):
+        raw = '\x1f'.join([language, model, speed, mood, text.strip()])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            audio = self._entries.get(key)
+            if audio is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return audio
+
+        if self.disk_dir:
+            path = os.path.join(self.disk_dir, f"{key}.mp3")
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    audio = f.read()
+                self._remember(key, audio)
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                return audio
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, audio):
+        self._remember(key, audio)
+        if self.disk_dir:
+            path = os.path.join(self.disk_dir, f"{key}.mp3")
+            tmp_path = f"{path}.tmp"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(audio)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"TTS cache: could not write {path}: {e}")
+
+    def _remember(self, key, audio):
+        if len(audio) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = audio
+            self._size += len(audio)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+tts_cache = TTSCache(TTS_CACHE_MAX_BYTES, TTS_CACHE_DIR)
+
+
+def prewarm_tts_cache():
+    """Synthesize the fixed phrases so the first caller never waits on TTS for them"""
+    failed = 0
+    for phrase in STATIC_PHRASES:
+        if text_to_speech(phrase, is_greeting=True) is None:
+            print(f"TTS prewarm failed for: '{phrase[:50]}'")
+            failed += 1
+    print(f"TTS cache prewarmed: {tts_cache.stats()}")
+    return failed
+
+
+warmup_status = {
+    'ready': not WARMUP_ENABLED,
+    'started_at': None,
+    'finished_at': None,
+    'steps': {}
+}
+
+
+def warm_upstream(client, url):
+    """Resolve the upstream host and park a keep-alive connection in its pool"""
+    host = urlparse(url).hostname
+    socket.getaddrinfo(host, 443, proto=socket.IPPROTO_TCP)
+    # Any HTTP status will do; the point is the finished TCP+TLS handshake
+    client.request('HEAD', f"https://{host}/", timeout=WARMUP_CONNECT_TIMEOUT)
+
+
+def run_warmup():
+    """Warm DNS, connection pools and static phrases, then report ready"""
+    warmup_status['started_at'] = time.time()
+    steps = warmup_status['steps']
+
+    for client, url in [(aisha_client, STT_URL), (groq_client, GROQ_URL)]:
+        step = f"connect_{client.name}"
+        try:
+            warm_upstream(client, url)
+            steps[step] = 'ok'
+        except Exception as e:
+            print(f"Warm-up step {step} failed: {e}")
+            steps[step] = f'failed: {e}'
+
+    # Also warms the TTS CDN pool through the audio downloads
+    failed = prewarm_tts_cache()
+    steps['tts_phrases'] = 'ok' if failed == 0 else f'failed: {failed} of {len(STATIC_PHRASES)}'
+
+    # Upstream failures are not fatal: turns degrade to text-only responses
+    warmup_status['finished_at'] = time.time()
+    warmup_status['ready'] = True
+    logger.info(f"Warm-up finished in {warmup_status['finished_at'] - warmup_status['started_at']:.2f}s: {steps}")
+
+
+# Process that owns the running warm-up (the master with gunicorn --preload, then each worker)
+warmup_pid = None
+
+
+def start_warmup():
+    """Spawn the warm-up once per process; /health reports 503 until it has finished"""
+    global warmup_pid
+    if not WARMUP_ENABLED or warmup_pid == os.getpid():
+        return
+    warmup_pid = os.getpid()
+    warmup_status.update(ready=False, started_at=None, finished_at=None, steps={})
+    eventlet.spawn(run_warmup)
+
+
+def text_to_speech(text, is_greeting=False, on_chunk=None, budget=None):
+    """Convert text to speech using Aisha API with hedged requests.
+
+    The synthesis request and the CDN download are each run through a
+    HedgedCall, so a slow attempt gets a parallel backup and a failed one is
+    retried immediately. When on_chunk is given, the CDN download is streamed
+    and every chunk is passed to it as soon as it arrives; only the response
+    headers are hedged, since the receiver must not get audio from two
+    downloads. With a turn budget, every attempt is capped by the time left
+    and no extra attempt is started once it could not finish in time.
+    """
+    cache_key = TTSCache.key(text)
+    cached = tts_cache.get(cache_key)
+    if cached is not None:
+        print(f"TTS: Cache hit for '{text[:50]}...' ({len(cached)} bytes)")
+        if on_chunk is not None:
+            for start in range(0, len(cached), AUDIO_CHUNK_SIZE):
+                on_chunk(cached[start:start + AUDIO_CHUNK_SIZE])
+        return cached
+
     # Use longer timeout for greeting since it's critical
-    timeout_seconds = 10 if is_greeting else 8
+    base_timeout = TTS_GREETING_TIMEOUT if is_greeting else TTS_TIMEOUT
+
+    def can_launch():
+        return budget is None or budget.can_retry()
+
+    def synthesize():
+        timeout_seconds = stage_timeout(budget, 'tts', base_timeout)
+        headers = {
+            'x-api-key': AISHA_API_KEY,
+            'X-Channels': 'stereo',
+            'X-Quality': '64k',
+            'X-Rate': '16000',
+            'X-Format': 'mp3',
+            'X-Speed': TTS_SPEED
+        }
+
+        # Use files parameter for multipart/form-data
+        files = {
+            'transcript': (None, text),
+            'language': (None, TTS_LANGUAGE),
+            'model': (None, TTS_MODEL),
+            'speed': (None, TTS_SPEED),
+            'mood': (None, TTS_MOOD)
+        }
+
+        print(f"TTS: Sending request to Aisha API (timeout={timeout_seconds}s)...")
+        response = aisha_client.post(TTS_URL, timeout=timeout_seconds, headers=headers, files=files)
+        if not response.ok:
+            print(f"TTS Response status: {response.status_code}")
+            print(f"TTS Response text: {response.text}")
+        response.raise_for_status()
 
-    for attempt in range(max_retries):
+        result = response.json()
+        audio_url = result.get('audio_path')
+        if not audio_url:
+            print(f"TTS: No audio_path in response: {result}")
+            raise ValueError("No audio_path in TTS response")
+        return audio_url
+
+    def download(audio_url):
+        timeout_seconds = stage_timeout(budget, 'tts', base_timeout)
+        response = cdn_client.get(audio_url, timeout=timeout_seconds, stream=on_chunk is not None)
         try:
-            print(f"TTS: Attempt {attempt + 1}/{max_retries} - Converting text: '{text[:50]}...'")
-
-            # Step 1: Request TTS conversion with multipart/form-data
-            headers = {
-                'x-api-key': AISHA_API_KEY,
-                'X-Channels': 'stereo',
-                'X-Quality': '64k',
-                'X-Rate': '16000',
-                'X-Format': 'mp3',
-                'X-Speed': '1.6'  # Faster speech
-            }
+            response.raise_for_status()
+            return response if on_chunk is not None else response.content
+        except Exception:
+            response.close()
+            raise
+
+    try:
+        print(f"TTS: Converting text: '{text[:50]}...'")
+        audio_url = tts_hedge.run(synthesize, TTS_MAX_ATTEMPTS, can_launch)
+        print(f"TTS: Got audio URL: {audio_url}")
+
+        print(f"TTS: Downloading audio from CDN...")
+        if on_chunk is None:
+            audio_content = cdn_hedge.run(lambda: download(audio_url), TTS_MAX_ATTEMPTS, can_launch)
+        else:
+            audio_response = cdn_hedge.run(lambda: download(audio_url), TTS_MAX_ATTEMPTS, can_launch,
+                                           discard=lambda r: r.close())
+            chunks = []
+            try:
+                # The headers made it within the turn budget; from here the audio
+                # is as good as playing, so the body only answers to the upstream deadline
+                with cdn_client.deadline(base_timeout):
+                    for chunk in audio_response.iter_content(AUDIO_CHUNK_SIZE):
+                        chunks.append(chunk)
+                        on_chunk(chunk)
+            finally:
+                audio_response.close()
+            audio_content = b''.join(chunks)
+        print(f"TTS: Success! Audio size: {len(audio_content)} bytes")
+        tts_cache.put(cache_key, audio_content)
+        return audio_content
+
+    except TurnBudgetExceeded:
+        print("TTS: Turn budget exhausted, sending text only")
+        return None
+
+    except requests.exceptions.Timeout:
+        print("TTS Timeout, giving up")
+        return None
+
+    except Exception as e:
+        print(f"TTS Error: {str(e)}")
+        return None
+
+
+class TurnCancelled(Exception):
+    """Raised inside a turn once a barge-in has cancelled its request"""
+
+
+class CancellationStats:
+    """Counts barge-in cancellations and estimates the upstream time they saved"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = {}  # stage -> moving average of completed call time
+        self.cancellations = 0
+        self.killed_calls = 0
+        self.saved_seconds = 0.0
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            previous = self._latency.get(stage)
+            self._latency[stage] = seconds if previous is None else previous * 0.8 + seconds * 0.2
+
+    def record_kill(self, stage, elapsed):
+        # Saved time: what the call would typically still have taken
+        with self._lock:
+            self.killed_calls += 1
+            self.saved_seconds += max(0.0, self._latency.get(stage, elapsed) - elapsed)
+
+    def record_cancellations(self, count):
+        with self._lock:
+            self.cancellations += count
 
-            # Use files parameter for multipart/form-data
-            files = {
-                'transcript': (None, text),
-                'language': (None, 'uz'),
-                'model': (None, 'gulnoza'),
-                'speed': (None, '1.6'),  # Faster speech
-                'mood': (None, 'happy')
+    def stats(self):
+        with self._lock:
+            return {
+                'cancellations': self.cancellations,
+                'killed_calls': self.killed_calls,
+                'saved_upstream_seconds': round(self.saved_seconds, 3),
+                'avg_stage_seconds': {stage: round(v, 3) for stage, v in self._latency.items()}
             }
 
-            print(f"TTS: Sending request to Aisha API (timeout={timeout_seconds}s)...")
-            response = requests.post(
-                TTS_URL,
-                headers=headers,
-                files=files,
-                timeout=timeout_seconds
-            )
-            response.raise_for_status()
 
-            # Step 2: Parse JSON response to get audio URL
-            result = response.json()
-            audio_url = result.get('audio_path')
+cancellation_stats = CancellationStats()
 
-            if not audio_url:
-                print(f"TTS: No audio_path in response: {result}")
-                raise ValueError("No audio_path in TTS response")
 
-            print(f"TTS: Got audio URL: {audio_url}")
+class CancelScope:
+    """Greenlets doing upstream work for one request, killed together on barge-in.
 
-            # Step 3: Download the actual audio file
-            print(f"TTS: Downloading audio from CDN...")
-            audio_response = requests.get(audio_url, timeout=timeout_seconds)
-            audio_response.raise_for_status()
+    Killing a greenlet aborts its blocking HTTP call or retry sleep on the
+    spot instead of letting it run until its timeout.
+    """
 
-            audio_content = audio_response.content
-            print(f"TTS: Success! Audio size: {len(audio_content)} bytes")
-            return audio_content
+    def __init__(self):
+        self.cancelled = False
+        self._workers = {}  # greenthread -> (stage, started)
 
-        except requests.exceptions.Timeout:
-            print(f"TTS Timeout on attempt {attempt + 1}")
-            if attempt < max_retries - 1:
-                wait_time = 1.0 if is_greeting else 0.5
-                print(f"Retrying after {wait_time}s...")
-                time.sleep(wait_time)
-            else:
-                print("TTS: Max retries reached, giving up")
-                return None
+    def track(self, stage, greenthread):
+        self._workers[greenthread] = (stage, time.time())
+        greenthread.link(self._finished)
+        return greenthread
 
-        except Exception as e:
-            print(f"TTS Error on attempt {attempt + 1}: {str(e)}")
-            if 'response' in locals():
-                print(f"TTS Response status: {response.status_code}")
-                print(f"TTS Response text: {response.text}")
-
-            if attempt < max_retries - 1:
-                wait_time = 1.0 if is_greeting else 0.5
-                print(f"Retrying after {wait_time}s...")
-                time.sleep(wait_time)
-            else:
-                return None
+    def _finished(self, greenthread):
+        stage, started = self._workers.pop(greenthread, (None, None))
+        if stage and not self.cancelled:
+            cancellation_stats.observe(stage, time.time() - started)
+
+    def run(self, stage, fn, *args, **kwargs):
+        """Run fn in a tracked greenlet and wait for it; raises TurnCancelled if killed"""
+        if self.cancelled:
+            raise TurnCancelled()
+        greenthread = self.track(stage, eventlet.spawn(fn, *args, **kwargs))
+        try:
+            result = greenthread.wait()
+        except greenlet.GreenletExit:
+            raise TurnCancelled()
+        if self.cancelled:
+            raise TurnCancelled()
+        return result
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        now = time.time()
+        for greenthread, (stage, started) in list(self._workers.items()):
+            cancellation_stats.record_kill(stage, now - started)
+            greenthread.kill()
+        self._workers.clear()
+
+
+# Cancel scopes of requests currently running on this worker, per session
+active_scopes = {}
+
+
+def register_scope(session_id, req_id, scope):
+    active_scopes.setdefault(session_id, {})[req_id] = scope
+
+
+def unregister_scope(session_id, req_id):
+    scopes = active_scopes.get(session_id, {})
+    scopes.pop(req_id, None)
+    if not scopes:
+        active_scopes.pop(session_id, None)
+
+
+def cancel_scopes(session_id, cancel_before_id):
+    """Abort in-flight upstream work of every request older than cancel_before_id"""
+    cancelled = 0
+    for req_id, scope in list(active_scopes.get(session_id, {}).items()):
+        if isinstance(req_id, int) and req_id < cancel_before_id and not scope.cancelled:
+            scope.cancel()
+            cancelled += 1
+    if cancelled:
+        cancellation_stats.record_cancellations(cancelled)
+    return cancelled
+
+
+class SentencePipeline:
+    """Synthesize sentences concurrently and stream their audio to one client in order.
+
+    Per sentence the client receives ai_response_part (text), then binary
+    ai_audio_chunk events with sequence numbers, then ai_audio_end. The
+    sentence at the head of the queue is streamed while it downloads; later
+    ones are buffered until their turn. ai_response_end closes the response.
+    """
+
+    def __init__(self, sid, request_id=None, is_cancelled=lambda: False, scope=None, budget=None):
+        self.sid = sid
+        self.request_id = request_id
+        self.is_cancelled = is_cancelled
+        self.scope = scope
+        # Only the first sentence races the turn deadline; later ones play after it
+        self.budget = budget
+        self.count = 0
+        self._pending = queue.Queue()
+        self._emitter = eventlet.spawn(self._emit_in_order)
+
+    def add(self, sentence, is_greeting=False):
+        """Start TTS for a sentence right away; it is emitted after earlier ones"""
+        chunks = queue.Queue()
+        budget = self.budget if self.count == 0 else None
+        job = eventlet.spawn(self._synthesize, sentence, is_greeting, chunks, budget)
+        # End-of-audio marker for the emitter; a link also fires when the job
+        # is killed before it ever ran (barge-in), unlike a finally in its body
+        job.link(lambda _: chunks.put(None))
+        if self.scope is not None:
+            self.scope.track('tts', job)
+        self._pending.put((self.count, sentence, chunks, job))
+        self.count += 1
+
+    def finish(self):
+        """Wait until every queued sentence has been emitted"""
+        self._pending.put(None)
+        self._emitter.wait()
+        if not self.is_cancelled():
+            socketio.emit('ai_response_end', self._payload({'parts': self.count}), to=self.sid)
+
+    @staticmethod
+    def _synthesize(sentence, is_greeting, chunks, budget):
+        return text_to_speech(sentence, is_greeting=is_greeting, on_chunk=chunks.put, budget=budget)
+
+    def _payload(self, payload):
+        if isinstance(self.request_id, int):
+            payload['request_id'] = self.request_id
+        return payload
+
+    def _emit_in_order(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            index, sentence, chunks, job = item
+
+            cancelled = self.is_cancelled()
+            if not cancelled:
+                socketio.emit('ai_response_part', self._payload({'index': index, 'text': sentence}), to=self.sid)
+
+            seq = 0
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                # Keep draining after a cancel so the TTS greenlet can finish
+                cancelled = cancelled or self.is_cancelled()
+                if cancelled:
+                    continue
+                socketio.emit('ai_audio_chunk', self._payload({
+                    'part': index,
+                    'seq': seq,
+                    'data': chunk
+                }), to=self.sid)
+                seq += 1
 
-    return None
+            try:
+                audio = job.wait()
+            except greenlet.GreenletExit:
+                audio = None
+                cancelled = True
+            if cancelled:
+                print(f"Request {self.request_id} cancelled, dropped sentence {index}")
+                continue
+            if not audio:
+                print(f'TTS failed for sentence {index}, sending text only')
+            socketio.emit('ai_audio_end', self._payload({
+                'part': index,
+                'chunks': seq,
+                'ok': audio is not None
+            }), to=self.sid)
 
 
 @app.route('/')
@@ -472,6 +3254,45 @@ def test_tts():
         return jsonify({"status": "error", "message": "TTS API is not responding"})
 
 
+@app.route('/health')
+def health():
+    """Readiness probe: 503 until startup warm-up has finished"""
+    # A worker forked after a preloaded import did not inherit the warm-up greenlet
+    start_warmup()
+    ready = warmup_status['ready']
+    return jsonify({
+        "status": "ready" if ready else "warming_up",
+        "steps": warmup_status['steps']
+    }), (200 if ready else 503)
+
+
+@app.route('/metrics')
+def metrics():
+    """Expose runtime counters for upstream connection pools"""
+    return jsonify({
+        "upstreams": {client.name: client.stats() for client in upstream_clients},
+        "tts_cache": tts_cache.stats(),
+        "hedging": {h.name: h.stats() for h in hedged_calls},
+        "system_prompt": prompt_stats(),
+        "llm_models": model_stats.stats(),
+        "faq_router": faq_router.stats(),
+        "booking": booking_stats.stats(),
+        "response_cache": response_cache.stats(),
+        "vad": vad_stats.stats(),
+        "stt_upload": stt_upload_stats.stats(),
+        "stt_stream": stt_stream_stats.stats(),
+        "cancellation": cancellation_stats.stats(),
+        "turn_budget": turn_budget_stats.stats(),
+        "sessions": sessions.stats(),
+        # Peek so that polling metrics neither keeps idle sessions alive nor recreates expired ones
+        "context_tokens": {
+            session_id: state['context_tokens']
+            for session_id, state in ((sid, sessions.peek_state(sid)) for sid in sessions.session_ids())
+            if state is not None
+        }
+    })
+
+
 @socketio.on('connect')
 def handle_connect():
     """Handle client connection"""
@@ -485,12 +3306,15 @@ def handle_disconnect():
     """Handle client disconnection"""
     logger.info('❌ Client disconnected')
     print('❌ Client disconnected')
+    released = release_socket(request.sid)
+    if released:
+        print(f"Cancelled work and scheduled cleanup for sessions: {released}")
 
 
 @socketio.on('start_call')
 def handle_start_call(data):
     """Handle call start - send initial greeting"""
-    session_id = data.get('session_id', 'default')
+    session_id = event_session_id(data)
     logger.info(f"📞 Starting call for session: {session_id}")
     print(f"📞 Starting call for session: {session_id}")
 
@@ -501,63 +3325,63 @@ def handle_start_call(data):
         print("WARNING: GROQ_API_KEY is not set!")
 
     # Reset conversation and runtime for this session
-    conversations[session_id] = []
-    state = get_session_state(session_id)
-    state['latest_request_id'] = 0
-    state['cancel_before_id'] = 0
+    sessions.reset(session_id)
+    bind_socket(session_id)
 
     # Generate initial greeting (shorter for faster processing)
-    greeting = "Assalomu alaykum! Men Sofia. Qanday yordam bera olaman?"
+    greeting = GREETING_TEXT
 
     # Add greeting to conversation history
-    conversations[session_id].append({"role": "assistant", "content": greeting})
+    sessions.append_history(session_id, {"role": "assistant", "content": greeting})
 
     print(f"Converting greeting to speech...")
-    # Convert to speech with greeting flag for longer timeout
-    audio_data = text_to_speech(greeting, is_greeting=True)
-
-    if audio_data:
-        print(f"TTS successful, audio size: {len(audio_data)} bytes")
-        audio_base64 = base64.b64encode(audio_data).decode('utf-8')
-        print(f"Sending greeting audio to client...")
-        emit('ai_response', {
-            'text': greeting,
-            'audio': audio_base64
-        })
-    else:
-        print("TTS failed for greeting - sending text only")
-        # Still send the greeting text even if TTS fails
-        emit('ai_response', {
-            'text': greeting,
-            'audio': None
-        })
-        # Immediately switch to listening mode
-        emit('start_listening', {})
+    # Stream greeting audio with the longer greeting timeout
+    pipeline = SentencePipeline(request.sid)
+    pipeline.add(greeting, is_greeting=True)
+    pipeline.finish()
 
 
 @socketio.on('process_audio')
 def handle_process_audio(data):
     """Process user audio input"""
     try:
-        session_id = data.get('session_id', 'default')
-        audio_base64 = data.get('audio')
+        session_id = event_session_id(data)
+        audio = data.get('audio')
         req_id = data.get('request_id', None)
         logger.info(f"🎤 Processing audio for session: {session_id}, request_id: {req_id}")
-        state = get_session_state(session_id)
+        bind_socket(session_id)
         if isinstance(req_id, int):
-            state['latest_request_id'] = max(state['latest_request_id'], req_id)
-
-        # Decode audio from base64
-        audio_data = base64.b64decode(audio_base64)
+            sessions.raise_state(session_id, 'latest_request_id', req_id)
+
+        budget = TurnBudget(TURN_DEADLINE)
+        scope = CancelScope()
+        register_scope(session_id, req_id, scope)
+
+        def is_cancelled():
+            return scope.cancelled or is_request_cancelled(session_id, req_id)
+
+        # Audio arrives as a binary attachment, as chunks streamed earlier
+        # under segment_id, or base64-encoded from older clients
+        audio_data = stream = None
+        if audio is None and 'segment_id' in data:
+            stream = take_segment_upload(session_id, data['segment_id'])
+            if stream is None:
+                print(f"No streamed chunks for segment {data['segment_id']} ({session_id})")
+                emit('no_speech_detected', {'message': 'Ovoz aniqlanmadi'})
+                return
+        elif isinstance(audio, (bytes, bytearray)):
+            audio_data = bytes(audio)
+        else:
+            audio_data = base64.b64decode(audio)
 
         # Cancellation check before STT
-        if isinstance(req_id, int) and req_id < state['cancel_before_id']:
+        if is_cancelled():
             print(f"Request {req_id} cancelled before STT")
             return
 
         # Step 1: Speech to Text
         emit('status', {'message': 'Tinglanmoqda...'})
-        user_text = speech_to_text(audio_data)
+        user_text = scope.run('stt', transcribe_segment, audio_data, stream, budget)
 
         if not user_text or len(user_text.strip()) == 0:
             print(f"No text from STT for session {session_id}")
@@ -570,79 +3394,111 @@ def handle_process_audio(data):
         emit('user_text', {'text': user_text})
 
         # Cancellation check before LLM
-        if isinstance(req_id, int) and req_id < state['cancel_before_id']:
+        if is_cancelled():
             print(f"Request {req_id} cancelled before LLM")
             return
 
-        # Step 2: Get LLM response
+        # Step 2 + 3: Stream LLM response, synthesizing each sentence as it completes
         emit('status', {'message': 'O\'ylanmoqda...'})
-        assistant_text = get_llm_response(user_text, session_id)
+        sid = request.sid
+        pipeline = SentencePipeline(sid, req_id, is_cancelled, scope, budget)
+
+        # Runs inside the LLM greenlet, outside the request context
+        def on_sentence(sentence):
+            if is_cancelled():
+                return
+            if pipeline.count == 0:
+                socketio.emit('status', {'message': 'Javob tayyorlanmoqda...'}, to=sid)
+            pipeline.add(sentence)
+
+        try:
+            # Booking steps and FAQ turns are answered locally from templates
+            # whose audio is already in the TTS cache
+            assistant_text = booking_flow.answer(user_text, session_id, on_sentence)
+            if assistant_text is None:
+                # Mid-booking, the FAQ answer asks again for the detail being collected
+                assistant_text = faq_router.answer(user_text, session_id, on_sentence,
+                                                   follow_up=booking_flow.reprompt(session_id))
+            if assistant_text is None:
+                assistant_text = scope.run('llm', get_llm_response, user_text, session_id, on_sentence, budget)
+        except TurnCancelled:
+            pipeline.finish()
+            raise
 
         if not assistant_text or len(assistant_text.strip()) == 0:
             print(f"No response from LLM for session {session_id}")
+            pipeline.finish()
             emit('error', {'message': 'Javob olinmadi. Iltimos qaytadan urinib ko\'ring.'})
             return
 
         print(f"Assistant response ({session_id}): {assistant_text}")
 
-        # Cancellation check before TTS
-        if isinstance(req_id, int) and req_id < state['cancel_before_id']:
-            print(f"Request {req_id} cancelled before TTS")
-            return
-
-        # Step 3: Text to Speech (bounded by timeout watchdog)
-        emit('status', {'message': 'Javob tayyorlanmoqda...'})
-        audio_response = text_to_speech(assistant_text)
+        # Fallback replies (LLM errors) never go through the stream
+        if pipeline.count == 0:
+            on_sentence(assistant_text)
 
-        if not audio_response:
-            # If TTS fails, still send the text without audio
-            print('TTS failed but sending text response')
-            payload = {
-                'text': assistant_text,
-                'audio': None
-            }
-            if isinstance(req_id, int):
-                payload['request_id'] = req_id
-            emit('ai_response', payload)
+        pipeline.finish()
+        if is_cancelled():
+            print(f"Request {req_id} cancelled during response")
             return
 
-        # Send response back to client
-        audio_base64 = base64.b64encode(audio_response).decode('utf-8')
-        payload = {
-            'text': assistant_text,
-            'audio': audio_base64
-        }
-        if isinstance(req_id, int):
-            payload['request_id'] = req_id
-        emit('ai_response', payload)
         # Let client resume listening immediately even if audio playback fails later
         emit('start_listening', {})
 
+        if stream is not None:
+            corrected = correct_early_transcript(session_id, stream, user_text)
+            if corrected:
+                emit('user_text', {'text': corrected, 'corrected': True})
+
+    except TurnCancelled:
+        print(f"Request {req_id} cancelled, in-flight upstream calls aborted")
     except Exception as e:
         print(f"Error processing audio: {str(e)}")
         emit('error', {'message': f'Xatolik yuz berdi: {str(e)}'})
+    finally:
+        if 'scope' in locals():
+            unregister_scope(session_id, req_id)
+
+
+@socketio.on('audio_chunk')
+def handle_audio_chunk(data):
+    """Receive a recorder timeslice while the user is still speaking"""
+    session_id = event_session_id(data)
+    chunk = data.get('data')
+    seq = data.get('seq')
+    if not isinstance(chunk, (bytes, bytearray)) or not isinstance(seq, int):
+        print(f"Ignoring malformed audio_chunk for session {session_id}")
+        return
+    segment_id = data.get('segment_id')
+    sid = request.sid
+
+    def on_partial(text):
+        socketio.emit('user_text', {'text': text, 'partial': True, 'segment_id': segment_id}, to=sid)
+
+    append_segment_chunk(session_id, segment_id, seq, bytes(chunk), on_partial)
 
 
 @socketio.on('end_call')
 def handle_end_call(data):
     """Handle call end"""
-    session_id = data.get('session_id', 'default')
+    session_id = event_session_id(data)
+
+    # Clear conversation history, runtime state and pending uploads
+    sessions.drop(session_id)
+    discard_segment_upload(session_id)
+    socket_sessions.get(request.sid, set()).discard(session_id)
+
 
-    # Clear conversation history
-    if session_id in conversations:
-        del conversations[session_id]
-    if session_id in session_runtime:
-        del session_runtime[session_id]
 @socketio.on('interrupt')
 def handle_interrupt(data):
     """Client indicates user barge-in; cancel any requests older than this id"""
-    session_id = data.get('session_id', 'default')
+    session_id = event_session_id(data)
     req_id = data.get('request_id', None)
-    state = get_session_state(session_id)
     if isinstance(req_id, int):
         # Cancel all work with request_id < (req_id + 1)
-        state['cancel_before_id'] = max(state['cancel_before_id'], req_id + 1)
-        print(f"Interrupt received for session {session_id}, cancel_before_id set to {state['cancel_before_id']}")
+        cancel_before_id = sessions.raise_state(session_id, 'cancel_before_id', req_id + 1)
+        aborted = cancel_scopes(session_id, cancel_before_id)
+        print(f"Interrupt received for session {session_id}, cancel_before_id set to {cancel_before_id}, aborted {aborted} in-flight requests")
 
     emit('call_ended', {'status': 'Call ended'})
 
@@ -650,20 +3506,20 @@ def handle_interrupt(data):
 @socketio.on('silence_timeout')
 def handle_silence_timeout(data):
     """Client indicates 5s user silence; nudge the user politely."""
-    session_id = data.get('session_id', 'default')
+    session_id = event_session_id(data)
     # Send a short AI prompt without LLM: direct phrase
-    prompt_text = "Men sizni eshita olmayapman. Iltimos, balandroq gapiring yoki qaytadan ayting."
-    # Convert to speech
-    audio_data = text_to_speech(prompt_text)
-    audio_base64 = base64.b64encode(audio_data).decode('utf-8') if audio_data else None
-    emit('ai_response', {
-        'text': prompt_text,
-        'audio': audio_base64
-    })
+    prompt_text = SILENCE_NUDGE_TEXT
+    pipeline = SentencePipeline(request.sid)
+    pipeline.add(prompt_text)
+    pipeline.finish()
     # Immediately resume listening on client
     emit('start_listening', {})
 
 
+# Runs on import so gunicorn workers (which never execute __main__) warm up too
+start_warmup()
+
+
 if __name__ == '__main__':
     print("\n" + "="*60)
     print("🏥 SOFIA VOICE ASSISTANT SERVER")
@@ -0,0 +1,56 @@
+"""Micro-benchmark for the NumPy audio preprocessing before the STT upload.
+
+Times condition_audio + normalize_loudness on synthetic speech-like int16
+input (a tone with noise, DC offset and rumble) at 16 kHz for several
+segment lengths, and once more with 48 kHz input so the resample is
+included. Reports milliseconds per call and per second of audio.
+
+Usage (from the project root):
+    python scripts/bench_preprocess.py --runs 50
+"""
+import os
+import sys
+import timeit
+import argparse
+
+# Importing app would otherwise start the warm-up against the real upstreams
+os.environ.setdefault('WARMUP_ENABLED', 'false')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+import app  # noqa: E402
+
+
+def synthetic_audio(seconds, sample_rate, seed=0):
+    """Quiet speech-band tone plus noise, a DC offset and 30 Hz rumble, as int16"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    signal = (1500 * np.sin(2 * np.pi * 220 * t) + 400 * np.sin(2 * np.pi * 30 * t)
+              + 300 * rng.standard_normal(t.size) + 800)
+    return np.clip(signal, -32768, 32767).astype(np.int16)
+
+
+def bench(samples, sample_rate, runs):
+    def preprocess():
+        app.normalize_loudness(app.condition_audio(samples, sample_rate))
+    return min(timeit.repeat(preprocess, number=1, repeat=runs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=50, help='timed runs per case (best is reported)')
+    parser.add_argument('--seconds', type=float, nargs='+', default=[1, 5, 15], help='segment lengths')
+    args = parser.parse_args()
+
+    cases = [(seconds, app.STT_SAMPLE_RATE) for seconds in args.seconds] + [(max(args.seconds), 48000)]
+    print(f"high-pass {app.STT_HIGH_PASS_HZ} Hz, best of {args.runs} runs")
+    for seconds, sample_rate in cases:
+        elapsed = bench(synthetic_audio(seconds, sample_rate), sample_rate, args.runs)
+        label = f"{seconds:g} s at {sample_rate // 1000} kHz"
+        if sample_rate != app.STT_SAMPLE_RATE:
+            label += " (resample included)"
+        print(f"{label:<36} {elapsed * 1000:7.2f} ms  {elapsed * 1000 / seconds:5.2f} ms per audio second")
+
+
+if __name__ == '__main__':
+    main()
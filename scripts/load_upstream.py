@@ -0,0 +1,80 @@
+"""Load check for the green upstream I/O layer.
+
+Starts a local eventlet server whose responses take --delay seconds and fires
+--calls concurrent requests at it through an UpstreamClient, the way the app
+calls Aisha, Groq and the CDN. With green I/O the wall time stays close to a
+single call's delay instead of growing with the number of calls. A second
+request reads a body that trickles in one byte at a time and must be cut off
+at its deadline rather than waiting for the whole body.
+
+Usage (from the project root):
+    python scripts/load_upstream.py --calls 500 --delay 0.5
+"""
+import os
+import sys
+import time
+import argparse
+
+# Importing app would otherwise start the warm-up against the real upstreams
+os.environ.setdefault('WARMUP_ENABLED', 'false')
+# Measure the I/O layer alone: lift the adaptive concurrency limit out of the way
+os.environ.setdefault('CONCURRENCY_LIMIT_INITIAL', '100000')
+os.environ.setdefault('CONCURRENCY_LIMIT_MAX', '100000')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402  (monkey-patches on import)
+import eventlet  # noqa: E402
+from eventlet import wsgi  # noqa: E402
+
+
+def start_server(delay, trickle_interval):
+    """Serve / after `delay` seconds and /trickle one byte per `trickle_interval`"""
+    def handler(env, start_response):
+        if env['PATH_INFO'] == '/trickle':
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+
+            def body():
+                for _ in range(20):
+                    eventlet.sleep(trickle_interval)
+                    yield b'x'
+            return body()
+        eventlet.sleep(delay)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'ok']
+
+    sock = eventlet.listen(('127.0.0.1', 0))
+    eventlet.spawn(wsgi.server, sock, handler, log_output=False, max_size=10000)
+    return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=500, help='concurrent upstream calls')
+    parser.add_argument('--delay', type=float, default=0.5, help='server response time in seconds')
+    parser.add_argument('--pool-size', type=int, default=50, help='UpstreamClient connection pool size')
+    parser.add_argument('--deadline', type=float, default=1.0, help='deadline for the trickling body')
+    args = parser.parse_args()
+
+    base_url = start_server(args.delay, trickle_interval=args.deadline / 5)
+    client = app.UpstreamClient('load', pool_size=args.pool_size)
+
+    started = time.time()
+    pool = eventlet.GreenPool(args.calls)
+    statuses = list(pool.imap(lambda _: client.get(f"{base_url}/", timeout=args.delay * 10).status_code,
+                              range(args.calls)))
+    elapsed = time.time() - started
+    print(f"{args.calls} concurrent {args.delay}s calls: {elapsed:.2f}s wall time, "
+          f"{statuses.count(200)} ok, serial would take {args.calls * args.delay:.0f}s")
+
+    started = time.time()
+    try:
+        response = client.get(f"{base_url}/trickle", timeout=args.deadline)
+        print(f"Trickling body was NOT cut off ({len(response.content)} bytes in {time.time() - started:.2f}s)")
+    except app.UpstreamDeadlineExceeded:
+        print(f"Trickling body cut off after {time.time() - started:.2f}s (deadline {args.deadline}s)")
+
+    print(client.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -26,6 +26,22 @@ let inFlightRequestId = null;
 let currentRequestId = 0; // monotonically increasing request ids
 let isProcessing = false; // STT/LLM/TTS in-flight on server
 
+// Upload mode: stream recorder chunks while the user talks (binary), or send
+// the whole segment as one binary attachment when it ends
+const STREAM_UPLOAD = true;
+let segmentCounter = 0;
+let segmentSeq = 0;
+let uploadChain = Promise.resolve(); // keeps chunk uploads in recorder order
+let partialMessage = null; // conversation line showing the current partial transcript
+let lastUserMessage = null; // latest final user line, rewritten if the server corrects it
+
+// Sentence-level response playback state
+let responseParts = [];        // part index -> {text, chunks, audioDone, onChunk}
+let nextPartIndex = 0;         // next part to play
+let responsePartsTotal = null; // set by ai_response_end
+let responsePartsRequestId = null;
+let isPlayingPart = false;
+
 // UI Elements
 const callButton = document.getElementById('callButton');
 const phoneIcon = document.getElementById('phoneIcon');
@@ -72,35 +88,88 @@ function initializeSocket() {
         console.log(data.status);
     });
 
-    socket.on('ai_response', (data) => {
+    socket.on('ai_response_part', (data) => {
         const dataRequestId = typeof data.request_id === 'number' ? data.request_id : null;
-        console.log('AI Response received:', data.text, 'request_id:', dataRequestId);
-        if (data.audio) {
-            console.log('Audio base64 length:', data.audio.length);
-        }
-        // Ignore stale responses
         if (dataRequestId !== null && dataRequestId < currentRequestId) {
-            console.warn('Ignoring stale ai_response with request_id', dataRequestId, 'current is', currentRequestId);
+            console.warn('Ignoring stale ai_response_part with request_id', dataRequestId);
             return;
         }
-        // Clear in-flight state for matching request
-        if (dataRequestId !== null && inFlightRequestId !== null && dataRequestId === inFlightRequestId) {
-            inFlightRequestId = null;
-            isProcessing = false;
-        }
-        // Clear any processing timeout
-        if (processingTimer) {
-            clearTimeout(processingTimer);
-            processingTimer = null;
+        if (data.index === 0) {
+            // First part of a new response
+            resetResponseParts();
+            responsePartsRequestId = dataRequestId;
+            if (dataRequestId !== null && dataRequestId === inFlightRequestId) {
+                inFlightRequestId = null;
+                isProcessing = false;
+            }
+            if (processingTimer) {
+                clearTimeout(processingTimer);
+                processingTimer = null;
+            }
+            hasSentSilencePrompt = false;
+        } else if (dataRequestId !== responsePartsRequestId) {
+            return;
         }
-        // Allow future silence prompts after a response
-        hasSentSilencePrompt = false;
-        playAIResponse(data.audio, data.text);
+        console.log('AI response part', data.index, 'received:', data.text);
+        getResponsePart(data.index).text = data.text;
+        playNextResponsePart();
+    });
+
+    socket.on('ai_audio_chunk', (data) => {
+        const dataRequestId = typeof data.request_id === 'number' ? data.request_id : null;
+        if (dataRequestId !== responsePartsRequestId) return;
+        const part = getResponsePart(data.part);
+        part.chunks.push(new Uint8Array(data.data));
+        if (part.onChunk) part.onChunk();
+        playNextResponsePart();
+    });
+
+    socket.on('ai_audio_end', (data) => {
+        const dataRequestId = typeof data.request_id === 'number' ? data.request_id : null;
+        if (dataRequestId !== responsePartsRequestId) return;
+        const part = getResponsePart(data.part);
+        part.audioDone = true;
+        console.log('Audio for part', data.part, 'complete, chunks:', data.chunks, 'ok:', data.ok);
+        if (part.onChunk) part.onChunk();
+        playNextResponsePart();
+    });
+
+    socket.on('ai_response_end', (data) => {
+        const dataRequestId = typeof data.request_id === 'number' ? data.request_id : null;
+        if (dataRequestId !== responsePartsRequestId) return;
+        console.log('AI response complete, parts:', data.parts);
+        responsePartsTotal = data.parts;
+        playNextResponsePart();
     });
 
     socket.on('user_text', (data) => {
+        // Partial transcripts update one line in place until the final text arrives
+        if (data.partial) {
+            if (!partialMessage) {
+                partialMessage = addToConversation('user', data.text);
+                partialMessage.classList.add('partial');
+            } else {
+                partialMessage.textContent = `Siz: ${data.text}`;
+            }
+            return;
+        }
+        // The turn started on a stable partial and the final transcript differed
+        if (data.corrected) {
+            console.log('User said (corrected):', data.text);
+            if (lastUserMessage) {
+                lastUserMessage.textContent = `Siz: ${data.text}`;
+            }
+            return;
+        }
         console.log('User said:', data.text);
-        addToConversation('user', data.text);
+        if (partialMessage) {
+            partialMessage.textContent = `Siz: ${data.text}`;
+            partialMessage.classList.remove('partial');
+            lastUserMessage = partialMessage;
+            partialMessage = null;
+        } else {
+            lastUserMessage = addToConversation('user', data.text);
+        }
     });
 
     socket.on('status', (data) => {
@@ -111,6 +180,10 @@ function initializeSocket() {
     socket.on('no_speech_detected', (data) => {
         console.log('No speech detected, continuing to listen');
         // Silently return to listening mode without showing error
+        if (partialMessage) {
+            partialMessage.remove();
+            partialMessage = null;
+        }
         isProcessing = false;
         inFlightRequestId = null;
         if (processingTimer) {
@@ -271,10 +344,27 @@ function startSegmentRecording() {
 
     segmentRecorder = new MediaRecorder(audioStream, options);
     segmentChunks = [];
+    const recorderSegmentId = ++segmentCounter;
+    segmentSeq = 0;
 
     segmentRecorder.ondataavailable = (event) => {
         if (event.data && event.data.size > 0) {
             segmentChunks.push(event.data);
+            if (STREAM_UPLOAD && socket) {
+                const chunk = event.data;
+                const seq = segmentSeq++;
+                uploadChain = uploadChain
+                    .then(() => chunk.arrayBuffer())
+                    .then(buffer => {
+                        socket.emit('audio_chunk', {
+                            session_id: sessionId,
+                            segment_id: recorderSegmentId,
+                            seq: seq,
+                            data: buffer
+                        });
+                    })
+                    .catch(err => console.error('Chunk upload failed:', err));
+            }
         }
     };
 
@@ -283,7 +373,7 @@ function startSegmentRecording() {
         if (segmentChunks.length > 0) {
             const blob = new Blob(segmentChunks, { type: 'audio/webm;codecs=opus' });
             console.log('Segment blob size:', blob.size);
-            handleSegmentComplete(blob);
+            handleSegmentComplete(blob, recorderSegmentId);
         }
         segmentRecorder = null;
         segmentChunks = [];
@@ -301,7 +391,7 @@ function stopSegmentRecording() {
 }
 
 // Handle completed segment
-function handleSegmentComplete(blob) {
+function handleSegmentComplete(blob, completedSegmentId) {
     if (!blob || blob.size < 5000) {
         console.log('Segment blob too small, skipping. Size:', (blob ? blob.size : 0));
         // Silently return to listening
@@ -347,50 +437,61 @@ function handleSegmentComplete(blob) {
         inFlightRequestId = ++currentRequestId;
         isProcessing = true;
         console.log('Sending segment, request_id', inFlightRequestId, 'bytes', blob.size);
-        sendAudioToServer(blob, inFlightRequestId);
+        sendAudioToServer(blob, inFlightRequestId, completedSegmentId);
     };
     reader.readAsArrayBuffer(blob.slice(0, 4));
 }
 
-// Play AI response
-function playAIResponse(audioBase64, text) {
-    console.log('playAIResponse called with text:', text);
+// Drop any queued response parts (new response or barge-in)
+function resetResponseParts() {
+    responseParts.forEach(part => { if (part) part.onChunk = null; });
+    responseParts = [];
+    nextPartIndex = 0;
+    responsePartsTotal = null;
+    responsePartsRequestId = null;
+    isPlayingPart = false;
+}
 
-    // If no audio (TTS failed), just show text and start listening
-    if (!audioBase64) {
-        console.warn('No audio data provided - TTS may have failed');
+function getResponsePart(index) {
+    if (!responseParts[index]) {
+        responseParts[index] = { text: null, chunks: [], audioDone: false, onChunk: null };
+    }
+    return responseParts[index];
+}
 
-        // Still show the text prominently
-        addToConversation('ai', text);
+// AI finished its whole response: hand the turn back to the user
+function finishAIResponse() {
+    isAISpeaking = false;
+    avatar.classList.remove('pulsing');
 
-        // Update UI to show AI responded (but no audio)
-        callButton.classList.remove('calling', 'user-speaking');
-        callButton.classList.add('ai-speaking');
-        avatar.classList.add('pulsing');
-        statusText.textContent = text;
-        statusText.classList.remove('hidden');
-        assistantName.classList.remove('hidden');
-
-        // After showing the text briefly, switch to listening
-        setTimeout(() => {
-            avatar.classList.remove('pulsing');
-            assistantName.classList.add('hidden');
-
-            // If this was the first greeting without audio, enable barge-in now
-            if (isFirstGreeting) {
-                console.log('First greeting completed (no audio) - barge-in now enabled');
-                isFirstGreeting = false;
-                setMicEnabled(true);
-            }
+    // After first greeting completes, enable barge-in for future responses
+    if (isFirstGreeting) {
+        console.log('First greeting completed - barge-in now enabled');
+        isFirstGreeting = false;
+        setMicEnabled(true);
+    }
 
-            if (isCallActive) {
-                startListening();
-            }
-        }, 3000); // Slightly longer to give user time to read
+    if (isCallActive) {
+        startListening();
+    }
+}
+
+// Play response parts in order as their audio arrives
+function playNextResponsePart() {
+    if (isPlayingPart) return;
 
+    const part = responseParts[nextPartIndex];
+    if (!part || part.text === null) {
+        if (responsePartsTotal !== null && nextPartIndex >= responsePartsTotal && isAISpeaking) {
+            finishAIResponse();
+        }
         return;
     }
+    // Wait until the first audio chunk (or the end marker) for this part
+    if (part.chunks.length === 0 && !part.audioDone) return;
 
+    nextPartIndex++;
+    isPlayingPart = true;
     isAISpeaking = true;
 
     // During first greeting, disable mic to prevent any barge-in attempts
@@ -403,77 +504,91 @@ function playAIResponse(audioBase64, text) {
     callButton.classList.add('ai-speaking');
     avatar.classList.add('pulsing');
     micIcon.classList.add('hidden');
-    // Keep waveform available (always listening), but you may keep it subtle via CSS
-    // waveform.classList.add('hidden');
     pulseWaves.classList.remove('inward');
-    statusText.classList.add('hidden');
     assistantName.classList.remove('hidden');
+    addToConversation('ai', part.text);
 
-    // Add to conversation
-    addToConversation('ai', text);
+    const partDone = () => {
+        isPlayingPart = false;
+        playNextResponsePart();
+    };
 
-    // Convert base64 to audio and play
-    const audioData = 'data:audio/mp3;base64,' + audioBase64;
-    console.log('Setting audio source, base64 length:', audioBase64.length);
+    if (part.chunks.length === 0) {
+        // TTS failed for this sentence: show the text briefly instead
+        console.warn('No audio for response part - TTS may have failed');
+        statusText.textContent = part.text;
+        statusText.classList.remove('hidden');
+        setTimeout(partDone, 1500);
+        return;
+    }
 
-    // Set volume to maximum
-    responseAudio.volume = 1.0;
-    responseAudio.src = audioData;
+    statusText.classList.add('hidden');
+    playPartAudio(part, partDone);
+}
 
-    responseAudio.onloadeddata = () => {
-        console.log('Audio loaded, attempting to play...');
-        console.log('Audio duration:', responseAudio.duration);
-    };
+// Play one part's MP3 chunks, progressively via MediaSource when available
+function playPartAudio(part, done) {
+    const canStream = window.MediaSource && MediaSource.isTypeSupported('audio/mpeg');
 
-    responseAudio.onerror = (e) => {
-        console.error('Audio error:', e);
-        console.error('Audio error details:', responseAudio.error);
+    if (!canStream) {
+        // Fallback: wait for the complete file, then play it from a Blob URL
+        const playWhenComplete = () => {
+            if (!part.audioDone) return;
+            part.onChunk = null;
+            startAudio(URL.createObjectURL(new Blob(part.chunks, { type: 'audio/mpeg' })), done);
+        };
+        part.onChunk = playWhenComplete;
+        playWhenComplete();
+        return;
+    }
+
+    const mediaSource = new MediaSource();
+    let sourceBuffer = null;
+    let appended = 0;
+
+    // Append chunks one at a time (appendBuffer is async), then close the stream
+    const pump = () => {
+        if (!sourceBuffer || sourceBuffer.updating || mediaSource.readyState !== 'open') return;
+        if (appended < part.chunks.length) {
+            sourceBuffer.appendBuffer(part.chunks[appended++]);
+        } else if (part.audioDone) {
+            part.onChunk = null;
+            mediaSource.endOfStream();
+        }
     };
 
-    responseAudio.onended = () => {
-        console.log('Audio playback ended');
-        isAISpeaking = false;
-        avatar.classList.remove('pulsing');
+    mediaSource.addEventListener('sourceopen', () => {
+        sourceBuffer = mediaSource.addSourceBuffer('audio/mpeg');
+        sourceBuffer.addEventListener('updateend', pump);
+        pump();
+    }, { once: true });
+    part.onChunk = pump;
 
-        // After first greeting completes, enable barge-in for future responses
-        if (isFirstGreeting) {
-            console.log('First greeting completed - barge-in now enabled');
-            isFirstGreeting = false;
-            setMicEnabled(true);
-        }
+    startAudio(URL.createObjectURL(mediaSource), done);
+}
 
-        // Immediately switch to listening mode for real-time feel
-        if (isCallActive) {
-            startListening();  // No delay
-        }
+function startAudio(url, done) {
+    const finish = () => {
+        URL.revokeObjectURL(url);
+        done();
     };
 
-    // Play with promise handling (with autoplay workaround)
-    responseAudio.muted = false;  // Ensure not muted
-    const playPromise = responseAudio.play();
+    responseAudio.volume = 1.0;
+    responseAudio.muted = false;
+    responseAudio.src = url;
+    responseAudio.onended = finish;
+    responseAudio.onerror = (e) => {
+        console.error('Audio error:', e, responseAudio.error);
+        finish();
+    };
 
+    const playPromise = responseAudio.play();
     if (playPromise !== undefined) {
         playPromise.then(() => {
             console.log('Audio playback started successfully');
         }).catch(err => {
             console.error('Error playing audio:', err);
-            console.error('Error name:', err.name);
-            console.error('Error message:', err.message);
-            isAISpeaking = false;
-
-            // If this was the first greeting and playback failed, enable barge-in
-            if (isFirstGreeting) {
-                console.log('First greeting playback failed - barge-in now enabled');
-                isFirstGreeting = false;
-                setMicEnabled(true);
-            }
-
-            // If initial greeting fails, still switch to listening
-            if (text.includes('Assalomu alaykum')) {
-                setTimeout(() => startListening(), 1000);
-            } else {
-                startListening();
-            }
+            finish();
         });
     }
 }
@@ -692,6 +807,7 @@ function startUnifiedVAD() {
 
                 // Cancel TTS playback immediately
                 try { responseAudio.pause(); } catch (e) {}
+                resetResponseParts();
                 isAISpeaking = false;
                 avatar.classList.remove('pulsing');
                 callButton.classList.add('user-speaking');
@@ -767,18 +883,23 @@ function startUnifiedVAD() {
 }
 
 // Send audio to server
-function sendAudioToServer(audioBlob, requestId) {
-    const reader = new FileReader();
-    reader.readAsDataURL(audioBlob);
-    reader.onloadend = () => {
-        const base64Audio = reader.result.split(',')[1];
-        const payload = {
-            session_id: sessionId,
-            audio: base64Audio,
-            request_id: typeof requestId === 'number' ? requestId : undefined
-        };
-        socket.emit('process_audio', payload);
+function sendAudioToServer(audioBlob, requestId, completedSegmentId) {
+    const payload = {
+        session_id: sessionId,
+        request_id: typeof requestId === 'number' ? requestId : undefined
     };
+
+    if (STREAM_UPLOAD) {
+        // Chunks are already on the server; queue behind any still uploading
+        payload.segment_id = completedSegmentId;
+        uploadChain = uploadChain.then(() => socket.emit('process_audio', payload));
+        return;
+    }
+
+    audioBlob.arrayBuffer().then(buffer => {
+        payload.audio = buffer;
+        socket.emit('process_audio', payload);
+    });
 }
 
 // End call
@@ -802,6 +923,7 @@ function endCall() {
     }
 
     // Stop audio playback
+    resetResponseParts();
     responseAudio.pause();
     responseAudio.src = '';
 
@@ -893,6 +1015,7 @@ function addToConversation(sender, text) {
 
     // Show conversation display (optional - for debugging)
     // conversationDisplay.classList.remove('hidden');
+    return messageDiv;
 }
 
 // Initialize on page load